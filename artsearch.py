@@ -1,10 +1,78 @@
+import BaseHTTPServer
+import json
+import os
+import SocketServer
 import sys
+import threading
+import urlparse
 from glob import glob
+from itertools import islice
+from Queue import Queue
 
-from trwbl import Document, Field, Index 
+from trwbl import Document, Field, Index, IndexException, default_cache
 import artsy
 
-def create_index():
+# documents indexed in memory before they are flushed to disk as a segment
+FLUSH_EVERY = 500
+# files read ahead of parsing and indexing
+READ_AHEAD = 16
+
+def read_files(filenames, read_ahead=READ_AHEAD):
+    """
+    Yield (filename, data) for each file.  Files are read in a thread, so
+    disk reads overlap with parsing and indexing, and at most read_ahead
+    of them wait in memory.
+    """
+    queue = Queue(read_ahead)
+    done = object()
+    errors = []
+    def reader():
+        try:
+            for filename in filenames:
+                file_handle = open(filename)
+                try:
+                    data = file_handle.read()
+                finally:
+                    file_handle.close()
+                queue.put((filename, data))
+        except Exception:
+            errors.append(sys.exc_info())
+        queue.put(done)
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+    while True:
+        item = queue.get()
+        if item is done:
+            break
+        yield item
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+def parse_files(files):
+    'Yield (filename, field dictionary) for each (filename, data).'
+    for filename, data in files:
+        yield filename, artsy.get_file_dict(data)
+
+def make_documents(parsed_files):
+    for filename, fields in parsed_files:
+        yield Document(
+            title=fields['title'],
+            date=fields['date'],
+            keyword=[x.strip() for x in fields['keywords'].split(',')],
+            description=fields['description'],
+            content=fields['contents'],
+        )
+
+def create_index(filename='index', pattern='../art/*', workers=None):
+    """
+    Index every article matching pattern.  Files stream through reading,
+    parsing, and indexing, and every FLUSH_EVERY documents the index is
+    saved, so memory use stays flat however many articles there are.  The
+    index is built beside filename, merged into a single segment streamed
+    to disk a token at a time, and renamed over it when complete; only 
+    then is it put in the cache, under filename, a chunk at a time.
+    """
     index = Index(fields=(
         Field('title', weight=0.8),
         Field('date', index=False),
@@ -12,47 +80,191 @@ def create_index():
         Field('keyword_s', weight=0, tokenizer=None),
         Field('description', weight=0.6),
         Field('content', store=False),
-    ))
-    for article in glob('../art/*'):
-        print "Adding %s ..." % article,
-        file_handle = open(article)
-        data = file_handle.read()
-        file_handle.close()
-        fields = artsy.get_file_dict(data)
-        doc = Document(
-            title=fields['title'],
-            date=fields['date'],
-            keyword=[x.strip() for x in fields['keywords'].split(',')],
-            description=fields['description'],
-            content=fields['contents'],
-        )
-        index.add(doc)
-        print "done."
+    ), cache=False)
+    build_filename = filename + '.building'
+    documents = make_documents(parse_files(read_files(glob(pattern))))
+    while True:
+        doc_counter = index.doc_counter
+        index.add_many(islice(documents, FLUSH_EVERY), workers=workers)
+        index.save(build_filename)
+        if index.doc_counter == doc_counter:
+            break
+        print "%d documents indexed ..." % index.doc_counter
+    index.optimize()
+    os.rename(build_filename, filename)
+    cache = default_cache()
+    if cache:
+        file_handle = open(filename, 'rb')
+        try:
+            cache.set_file(filename, file_handle)
+        finally:
+            file_handle.close()
     print len(index.documents)
-    index.save('index')
-    
+
 def search_index(query):
     index = Index('index')
-    results = index.search(query)
+    results = index.search(query, fields=('title',))
     for document in results.documents:
         print "%02d %s %s" % (document.id, document.score, document['title'])
 
-def get_tokens(field):
+class SearchHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers GET /search?q=query&limit=10&offset=0&fields=title with the 
+    results as JSON: the total, a suggestion if nothing matched, and the 
+    documents with their IDs and scores.  Only the stored fields named in
+    fields, separated by commas, are returned if it is given.  A bad 
+    query, limit, or offset is answered 400 with the error as JSON.
+    """
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != '/search':
+            self.send_error(404)
+            return
+        params = urlparse.parse_qs(url.query)
+        query = params.get('q', [''])[0]
+        try:
+            limit = int(params.get('limit', [10])[0])
+            offset = int(params.get('offset', [0])[0])
+        except ValueError:
+            limit = offset = -1
+        if limit < 0 or offset < 0:
+            self.send_json(400, {'error': 
+                    "limit and offset must be numbers of at least 0"})
+            return
+        fields = params.get('fields')
+        if fields is not None:
+            fields = [x for x in fields[0].split(',') if x]
+        index = self.server.get_index()
+        try:
+            results = index.search(query, limit, offset, fields=fields)
+            response = {
+                'query': query,
+                'total': results.total,
+                'documents': [dict(document.fields, id=document.id, 
+                        score=document.score) 
+                        for document in results.documents],
+            }
+            if not results.total:
+                response['suggestion'] = index.suggest(query)
+        except IndexException, error:
+            self.send_json(400, {'query': query, 'error': str(error)})
+            return
+        self.send_json(200, response)
+
+    def send_json(self, status, response):
+        body = json.dumps(response)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, 
+                    *args)
+
+class SearchServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Serves searches of one index, opened once and shared by the threads
+    handling requests.  The file is checked on each request and opened 
+    again if it has been saved or replaced since; until a save is 
+    complete, the index opened before is served.  By default only 
+    localhost can connect.
+
+    >>> import shutil, tempfile, urllib2
+    >>> directory = tempfile.mkdtemp()
+    >>> filename = os.path.join(directory, 'index')
+    >>> index = Index(fields=(Field('title'),), cache=False)
+    >>> index.add(Document(title='Troll bridge'))
+    >>> index.save(filename)
+    >>> server = SearchServer(filename, ('127.0.0.1', 0), quiet=True)
+    >>> thread = threading.Thread(target=server.serve_forever)
+    >>> thread.daemon = True
+    >>> thread.start()
+    >>> url = 'http://127.0.0.1:%d/search?' % server.server_address[1]
+    >>> response = json.load(urllib2.urlopen(url + 'q=troll'))
+    >>> response['total'], response['documents'][0]['title']
+    (1, u'Troll bridge')
+    >>> for query in ('q=bad:field', 'q=troll&limit=-1'):
+    ...     try:
+    ...         urllib2.urlopen(url + query)
+    ...     except urllib2.HTTPError, error:
+    ...         print error.code, json.load(error)['error']
+    400 Field 'bad' not defined.
+    400 limit and offset must be numbers of at least 0
+
+    A save that has appended a segment but not yet its trailer is not 
+    served until it is done.
+
+    >>> index_file = open(filename, 'ab')
+    >>> index_file.write('half a segment')
+    >>> index_file.close()
+    >>> json.load(urllib2.urlopen(url + 'q=troll'))['total']
+    1
+    >>> index.add(Document(title='Troll mountain'))
+    >>> index.save(filename)
+    >>> json.load(urllib2.urlopen(url + 'q=troll'))['total']
+    2
+    >>> server.shutdown()
+    >>> server.server_close()
+    >>> shutil.rmtree(directory)
+    """
+    daemon_threads = True
+
+    def __init__(self, filename='index', address=('127.0.0.1', 8000), 
+            quiet=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, SearchHandler)
+        self.filename = filename
+        self.quiet = quiet
+        self.index = None
+        self.index_signature = None
+        self.index_lock = threading.Lock()
+        self.get_index()
+
+    def get_index(self):
+        try:
+            stat = os.stat(self.filename)
+            signature = (stat.st_ino, stat.st_size, stat.st_mtime)
+            if signature != self.index_signature:
+                self.index_lock.acquire()
+                try:
+                    # another thread may have opened it while we waited
+                    if signature != self.index_signature:
+                        self.index = Index(self.filename, cache=False)
+                        self.index_signature = signature
+                finally:
+                    self.index_lock.release()
+        except (IndexException, EnvironmentError, ValueError):
+            # the file is being appended to or replaced; keep serving the
+            # index we have, and try the file again on the next request
+            if self.index is None:
+                raise
+        return self.index
+
+def serve(port=8000, filename='index'):
+    server = SearchServer(filename, ('127.0.0.1', port))
+    print "Serving %s on http://127.0.0.1:%d/search?q= ..." % (filename, 
+            port)
+    server.serve_forever()
+
+def get_tokens(field, n=None):
     index = Index('index')
     field = index.fields[field]
-    return field.get_token_list()
+    return field.top_terms(n)
 
 if __name__ == '__main__':
-    if len(sys.argv) > 2:
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        serve(*[int(x) for x in sys.argv[2:3]])
+    elif len(sys.argv) > 2:
         if sys.argv[1] == 'search':
             print "Searching index ..."
             search_index(sys.argv[2])
         elif sys.argv[1] == 'tokens':
             print "Tokens for %s:" % sys.argv[2]
             tokens = get_tokens(sys.argv[2])
-            for token_value, token_locations in tokens:
-                print "\t %s (%s locations)" % (token_value, 
-                        len(token_locations))
+            for token_value, document_count in tokens:
+                print "\t %s (%s documents)" % (token_value, document_count)
     else:
         print "Creating index ..."
         create_index()
@@ -1,10 +1,14 @@
 #!/usr/bin/python
 
-import sys, os, glob, re, time
+import sys, os, glob, re, time, hashlib, json
 from markdown import markdown
 #from mako.template import Template
 #from mako.lookup import TemplateLookup
 
+# build manifest, kept in the site directory
+MANIFEST = '.artsy_manifest.json'
+MANIFEST_VERSION = 1
+
 def head_split(filestring):
     'Split the head from the contents.'
     # everything up to first blank line is the head
@@ -70,6 +74,14 @@ def get_just_name(filename):
     just_name = os.path.splitext(os.path.basename(filename))[0]
     return just_name
 
+def read_file(filename):
+    'the bytes of a file'
+    f = open(filename, 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
 def del_html(site_dir, filenames):
     'Delete each html file for which there is no corresponding mdwn file.'
 
@@ -78,41 +90,95 @@ def del_html(site_dir, filenames):
 
     htmlFileList = glob.glob(os.path.join(site_dir, '*.html'))
     for htmlName in htmlFileList:
-        if get_just_name(htmlName) not in just_names:
+        # index.html is written by index_n_feed, and only when it changes
+        if get_just_name(htmlName) not in just_names and \
+                get_just_name(htmlName) != 'index':
             print 'Removing %s...' % htmlName,
             os.remove(htmlName)
             print 'done.'
 
+def content_hash(data):
+    'hash of a source file or template, for telling when it has changed'
+    return hashlib.sha1(data).hexdigest()
+
+def templates_hash(site_dir):
+    'one hash of every template, so editing any of them rebuilds everything'
+    digest = hashlib.sha1()
+    for filename in sorted(glob.glob(os.path.join(site_dir, 'templates/*'))):
+        digest.update(get_just_name(filename))
+        digest.update(read_file(filename))
+    return digest.hexdigest()
+
+def load_manifest(site_dir):
+    'Read the build manifest, or start an empty one that rebuilds everything.'
+    # the manifest holds the hash of the templates, and for each article
+    # (by name) the hash of its source and its file_dict
+    try:
+        manifest = json.loads(read_file(os.path.join(site_dir, MANIFEST)))
+    except (IOError, ValueError):
+        manifest = {}
+    if manifest.get('version') != MANIFEST_VERSION:
+        manifest = {'version': MANIFEST_VERSION, 'templates': None, 
+                'articles': {}}
+    return manifest
+
+def save_manifest(site_dir, manifest):
+    'Write the manifest beside the old one and rename it into place.'
+    manifest_name = os.path.join(site_dir, MANIFEST)
+    temp_name = '%s.%s.tmp' % (manifest_name, os.getpid())
+    f = open(temp_name, 'w')
+    try:
+        json.dump(manifest, f)
+    finally:
+        f.close()
+    os.rename(temp_name, manifest_name)
+
 # for storing tuples of (date, filename, file_dict) for index creation
 date_first_list = []
 
 def process_files(filenames, site_dir):
     'Grab metadata out of source files and create html files'
+    # articles whose source and templates are unchanged since the last 
+    # build are neither parsed nor rendered; their metadata comes from the
+    # manifest.  Returns whether anything was rebuilt or removed.
+    manifest = load_manifest(site_dir)
+    templates = templates_hash(site_dir)
+    if manifest['templates'] != templates:
+        manifest['templates'] = templates
+        manifest['articles'] = {}
+    old_articles = manifest['articles']
+    articles = manifest['articles'] = {}
+    # fetched once for every article, rather than looked up for each
+    art_tmpl = tmpl_lookup.get_template('art.html')
+    changed = False
 
     for filename in filenames:
-        print 'Processing %s...' % filename,
-        f = open(filename).read().decode('utf8')
-        file_dict = get_file_dict(f)
-        # add "last modified" metadata
-        if 'date' not in file_dict:
-            file_dict['date'] = set_date(filename, f)
-        file_dict['created'] = file_dict['date']
-        file_dict['modified'] = file_time(filename)
-        file_dict['contents'] = markdown(file_dict['contents'])
-        #print file_dict.keys()
-        print 'done.'
-
-        justName = os.path.splitext(os.path.basename(filename))[0]
-        htmlName = os.path.join(site_dir, justName) + '.html'
-        if os.path.exists(htmlName) and \
-                os.path.getmtime(filename) < os.path.getmtime(htmlName):
-            #print '%s not written: File is current' % htmlName
-            pass  # only talk when you walk
+        link = get_just_name(filename)
+        htmlName = os.path.join(site_dir, link) + '.html'
+        data = read_file(filename)
+        digest = content_hash(data)
+        article = old_articles.get(link)
+        if article and article['hash'] == digest and \
+                os.path.exists(htmlName):
+            # only talk when you walk
+            file_dict = article['file_dict']
         else:
+            changed = True
+            print 'Processing %s...' % filename,
+            f = data.decode('utf8')
+            file_dict = get_file_dict(f)
+            # add "last modified" metadata
+            if 'date' not in file_dict:
+                file_dict['date'] = set_date(filename, f)
+                digest = content_hash(read_file(filename))
+            file_dict['created'] = file_dict['date']
+            file_dict['modified'] = file_time(filename)
+            file_dict['contents'] = markdown(file_dict['contents'])
+            file_dict['link'] = link
+            print 'done.'
+
             print 'Writing %s...' % htmlName,
-            # get article template and generate html file with 
-            # assigned variables
-            art_tmpl = tmpl_lookup.get_template('art.html')
+            # generate html file with assigned variables
             out_stream = art_tmpl.render(
                 title = file_dict.get('title', ''),
                 created = file_dict.get('created', ''),
@@ -128,16 +194,20 @@ def process_files(filenames, site_dir):
                 print 'done.'
             finally:
                 file_handle.close()
+        articles[link] = {'hash': digest, 'file_dict': file_dict}
             
         # collect file data, date first, for sorting for index.html
-        link = get_just_name(filename)
-        file_dict['link'] = link
         date_tuple = (file_dict['date'], file_dict)
         date_first_list.append(date_tuple)
         date_first_list.sort(reverse=True)
         if len(date_first_list) > 30:
             date_first_list.pop()
 
+    if set(old_articles) != set(articles):
+        changed = True
+    save_manifest(site_dir, manifest)
+    return changed
+
 def index_n_feed(filenames):
     if date_first_list:
         dict_list = [dict_ for (date, dict_) in date_first_list]
@@ -183,8 +253,9 @@ def main(site_dir):
     filenames.sort()
 
     del_html(site_dir, filenames)
-    process_files(filenames, site_dir)
-    index_n_feed(filenames)
+    changed = process_files(filenames, site_dir)
+    if changed or not os.path.exists(os.path.join(site_dir, 'index.html')):
+        index_n_feed(filenames)
 
 if __name__ == '__main__':
     try: 
@@ -192,10 +263,15 @@ if __name__ == '__main__':
     except IndexError: 
         site_dir = os.path.dirname(__file__)
 
+    # only building the site needs mako; artsearch imports this module
+    # for get_file_dict
+    from mako.lookup import TemplateLookup
     tmpl_lookup = TemplateLookup(
             directories=[site_dir + '/templates'], 
             module_directory=site_dir + '/mako_modules',
             input_encoding='utf-8', 
-            output_encoding='utf-8')
+            output_encoding='utf-8',
+            # templates are looked up once per build
+            filesystem_checks=False)
 
     main(site_dir)
@@ -32,10 +32,53 @@ Example
 ...     print doc['title']
 ...
 Hoopdie McGee
+>>> for doc in index2.search('"the mountain"~1').documents:
+...     print doc['title']
+...
+The Troll Mountain
+>>> index2.search('keyword_str:troll').total
+0
+>>> for doc in index2.search('keyword_str:(Troll -soup)').documents:
+...     print doc['title']
+...
+The Troll Mountain
+>>> [doc['title'] for doc in index2.search('tro* mount?in').documents]
+['The Troll Mountain']
+>>> index2.search('author:[horrible TO m]').total
+1
+>>> [doc['title'] for doc in index2.search('mountian~1').documents]
+['The Troll Mountain']
+>>> index2.suggest('hoopdy mcgee')
+'hoopdie mcgee'
+>>> index2.search('  baby ').total
+1
+>>> index2.query_cache.hits, index2.query_cache.misses
+(1, 7)
+>>> sorted(doc['title'] for doc in 
+...         index2.search('soup OR mountain').documents)
+['Hoopdie McGee', 'The Troll Mountain']
+>>> index2.search('+mountain OR soup -hoopdie').total
+1
 """
 
+from array import array
+import bisect
+from collections import OrderedDict
 import cPickle as pickle
+import heapq
+import itertools
+import logging
+import math
+import mmap
+import multiprocessing
+import os
 import re
+import struct
+import sys
+import threading
+import zlib
+from cStringIO import StringIO
+from timeit import default_timer
 
 try:  # use memcache if we got it
     import memcache
@@ -52,19 +95,19 @@ class IndexException(Exception):
 
 QUERY_RE = re.compile(r"""
 "(.+?)(?:"|$)     # anything surrounded by quotes (or to end of line)
+(?:~(\d+))?       # with an optional ~slop
 |                 # or
 ([+-]?)           # grab an optional + or -
 ([\S]+):          # then non-whitespace, then a colon 
 (
   ".+?(?:"|$)|    # then anything surrounded by quotes 
   \(.+?(?:\)|$)|  # or parentheses (or to end of line)
+  \[.+?(?:\]|$)|  # or a [low TO high] range (or to end of line)
   [\S]+           # or non-whitespace strings
 )|                # or
 ([+-]?)           # grab an optional + or -
 ([\S]+)           # and non-whitespace strings without colons
 """, re.VERBOSE | re.UNICODE)
-def parse_query(query):
-    return QUERY_RE.findall(query)
 
 FIELD_QUERY_RE = re.compile(r"""
 "(.+?)(?:"|$)     # anything surrounded by quotes (or to end of line)
@@ -75,63 +118,571 @@ FIELD_QUERY_RE = re.compile(r"""
 def parse_field_query(field_query):
     return FIELD_QUERY_RE.findall(field_query)
 
-class Tokenizer(object):
-    def __init__(self, lower=True, re_string=r'[\w\']+'):
-        self.lower = lower
-        self.tokens_re = re.compile(re_string)
+RANGE_RE = re.compile(r"\[\s*(\S+)\s+TO\s+(\S+?)\s*(?:\]|$)")
+def parse_range(field_query):
+    """
+    Returns the low and high terms of a [low TO high] range, where * 
+    leaves that end open, or None if it isn't one.
+
+    >>> parse_range('[a TO m]'), parse_range('[* TO m]'), parse_range('m')
+    (('a', 'm'), (None, 'm'), None)
+    """
+    match = RANGE_RE.match(field_query)
+    if not match:
+        return None
+    return tuple(None if x == '*' else x for x in match.groups())
+
+# the most terms a wildcard in a scored query part expands to
+MAX_EXPANSIONS = 64
+
+def is_pattern(word):
+    return '*' in word or '?' in word
+
+FUZZY_RE = re.compile(r"(.+?)~(\d*)$")
+def parse_fuzzy(word):
+    """
+    Returns the term and most edits of a term~edits word, with ~ alone 
+    allowing MAX_EDITS, or None if it isn't one.
+
+    >>> parse_fuzzy('troll~1'), parse_fuzzy('troll~'), parse_fuzzy('troll')
+    (('troll', 1), ('troll', 2), None)
+    """
+    match = FUZZY_RE.match(word)
+    if not match:
+        return None
+    term, edits = match.groups()
+    return term, min(int(edits or MAX_EDITS), MAX_EDITS)
+
+# the most edits a fuzzy term may be from the tokens it matches
+MAX_EDITS = 2
+# the most tokens checked for each fuzzy term, closest candidates first
+MAX_FUZZY_CANDIDATES = 200
+# the longest tokens a short fuzzy term is checked against without sharing
+# a trigram
+SHORT_TOKEN = 5
+# terms read from the saved lists by count, per token asked for from each 
+# segment, before top_terms counts every token instead
+TOP_TERMS_READS = 8
+
+def _pattern_re(pattern):
+    """
+    Compile a wildcard pattern in UTF-8 bytes, where * matches any run of
+    characters and ? any one character.
+    """
+    parts = []
+    for part in re.split(r'([*?])', pattern):
+        if part == '*':
+            parts.append('.*')
+        elif part == '?':
+            parts.append('(?:[\x00-\x7f]|[\xc0-\xff][\x80-\xbf]+)')
+        else:
+            parts.append(re.escape(part))
+    return re.compile(''.join(parts) + r'\Z', re.DOTALL)
+
+# how a query clause has to match: MUST clauses always, and at least one
+# of a group of SHOULD clauses unless the group has a MUST clause too, 
+# when they only add to scores.  MUST_NOT clauses must not match.
+MUST = 'must'
+SHOULD = 'should'
+MUST_NOT = 'must_not'
+
+class TermQuery(object):
+    """
+    A word to find in every weighted field, or in one field as the value
+    of a FieldQuery.  Patterns and term~edits words are expanded against
+    the tokens of each field when searched; other words are analyzed 
+    once into tokens, which maps field names to the word's tokens there.
+    """
+    def __init__(self, word):
+        self.word = word
+        self.pattern = is_pattern(word)
+        self.fuzzy = None if self.pattern else parse_fuzzy(word)
+        self.key = ('term', word)
+        self.tokens = {}
+
+    def analyze(self, index, field_names):
+        if not self.pattern and not self.fuzzy:
+            for field_name in field_names:
+                self.tokens[field_name] = \
+                        index.fields[field_name].tokenizer.tokenize(self.word)
+
+    def empty(self):
+        """Whether the word analyzed to no tokens in any field."""
+        return (not self.pattern and not self.fuzzy and 
+                not any(self.tokens.itervalues()))
+
+class PhraseQuery(object):
+    """
+    Words to find in order, each within slop positions of the one before.
+    tokens maps field names to the phrase's tokens there.
+    """
+    def __init__(self, phrase, slop=0):
+        self.phrase = phrase
+        self.slop = slop
+        self.key = ('phrase', phrase, slop)
+        self.tokens = {}
+
+    def analyze(self, index, field_names):
+        for field_name in field_names:
+            self.tokens[field_name] = \
+                    index.fields[field_name].tokenizer.tokenize(self.phrase)
+
+    def empty(self):
+        return not any(self.tokens.itervalues())
+
+class FieldQuery(object):
+    """
+    A filter on one field: a TermQuery or PhraseQuery value that has to 
+    be found there.  It doesn't add to scores.
+    """
+    def __init__(self, field, value):
+        self.field = field
+        self.value = value
+        self.key = ('field', field, value.key)
+
+    def analyze(self, index, field_names=None):
+        self.value.analyze(index, [self.field])
+
+    def empty(self):
+        return self.value.empty()
+
+class RangeQuery(object):
+    """
+    A filter on one field for tokens between low and high, inclusive, 
+    where None leaves that end open.  The bounds go through the field's 
+    tokenizer.
+    """
+    def __init__(self, field, low, high):
+        self.field = field
+        self.bounds = (low, high)
+        self.key = ('range', field, low, high)
+
+    def analyze(self, index, field_names=None):
+        tokenizer = index.fields[self.field].tokenizer
+        bounds = []
+        for bound in self.bounds:
+            if bound is not None:
+                tokens = tokenizer.tokenize(bound)
+                bound = tokens and tokens[0] or bound
+            bounds.append(bound)
+        self.bounds = tuple(bounds)
+
+    def empty(self):
+        return False
+
+class BooleanQuery(object):
+    """
+    A whole query: groups of (occur, part_number, query) clauses, where
+    part_number counts the parts of the query string, for keeping 
+    statistics by part.  Each part, or each part of a field:(...) query,
+    is a MUST clause of its own, with or without a +, or a MUST_NOT clause
+    with a -.  Parts joined by OR are grouped as SHOULD clauses instead, 
+    except that those with a + stay MUST clauses.  key is the same for 
+    queries that only differ in spacing.
+
+    Words and phrases that analyze to no tokens, such as stopwords, are
+    left out of the query once analyzed, unless nothing positive would be
+    left, so they neither match nor exclude anything.
+
+    >>> index = Index(fields=(Field('title', weight=0.5, 
+    ...         tokenizer=Analyzer((lowercase, StopFilter()))),), cache=False)
+    >>> index.add(Document(title='The Troll'))
+    >>> [index.search(x).total for x in ('the troll', 'troll "the"', 
+    ...         'title:the troll', 'the')]
+    [1, 1, 1, 0]
+    """
+    def __init__(self, groups):
+        self.groups = groups
+        self._set_key()
+
+    def _set_key(self):
+        self.key = tuple(tuple((occur, part_number, query.key) 
+                for occur, part_number, query in group) 
+                for group in self.groups)
+
+    def clauses(self):
+        return [clause for group in self.groups for clause in group]
+
+    def analyze(self, index):
+        """Analyze every word for the index's fields, and return self."""
+        field_names = [x[1] for x in index.weighted_fields]
+        for occur, part_number, query in self.clauses():
+            query.analyze(index, field_names)
+        groups = [[x for x in group if not x[2].empty()] 
+                for group in self.groups]
+        groups = [x for x in groups if x]
+        if any(x[0] != MUST_NOT for group in groups for x in group):
+            self.groups = groups
+            self._set_key()
+        return self
+
+def parse_query(query):
+    """
+    Parse a query string into a BooleanQuery.
+
+    >>> [[(x[0], x[2].key) for x in group] for group in 
+    ...         parse_query('a OR "b c" -d +e OR f:g').groups]
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [[('should', ('term', 'a')), ('should', ('phrase', 'b c', 0))], 
+     [('must_not', ('term', 'd'))], 
+     [('must', ('term', 'e')), ('should', ('field', 'f', ('term', 'g')))]]
+    """
+    groups = []
+    joined = False
+    for part_number, part in enumerate(QUERY_RE.findall(query)):
+        phrase, slop, field_op, field, field_query, word_op, word = part
+        leaves = []
+        if phrase:
+            leaves.append(('', PhraseQuery(phrase, int(slop or 0))))
+        if field_query and field_query.startswith('['):
+            low, high = parse_range(field_query) or ('', '')
+            leaves.append((field_op, RangeQuery(field, low, high)))
+        elif field_query:
+            if field_query.startswith('('):
+                field_query = field_query.strip('()')
+            for fq_phrase, fq_op, fq_word in parse_field_query(field_query):
+                ops = (field_op, fq_op)
+                if fq_word == 'OR' and not fq_op:
+                    leaves.append(('', None))
+                    continue
+                if fq_phrase:
+                    value = PhraseQuery(fq_phrase)
+                else:
+                    value = TermQuery(fq_word)
+                if '-' in ops:
+                    leaves.append(('-', FieldQuery(field, value)))
+                else:
+                    leaves.append(('+' if '+' in ops else '', 
+                            FieldQuery(field, value)))
+        if word == 'OR' and not word_op:
+            leaves.append(('', None))
+        elif word:
+            leaves.append((word_op, TermQuery(word)))
+        for op, leaf in leaves:
+            if leaf is None:
+                joined = True
+                continue
+            if joined and groups and op != '-' and groups[-1][-1][0] != '-':
+                groups[-1].append((op, part_number, leaf))
+            else:
+                groups.append([(op, part_number, leaf)])
+            joined = False
+    clauses = []
+    for group in groups:
+        group_clauses = []
+        for op, part_number, leaf in group:
+            if op == '-':
+                occur = MUST_NOT
+            elif op == '+' or len(group) == 1:
+                occur = MUST
+            else:
+                occur = SHOULD
+            group_clauses.append((occur, part_number, leaf))
+        clauses.append(group_clauses)
+    return BooleanQuery(clauses)
+
+# unicode terms, which intern() won't take, kept like Analyzer.terms: 
+# dropped all together once there are more than INTERN_SIZE of them
+INTERN_SIZE = 100000
+_interned = {}
+
+def _intern(term):
+    """Return the one shared copy of term."""
+    if type(term) is str:
+        # interned strs are freed when nothing else holds them
+        return intern(term)
+    if len(_interned) > INTERN_SIZE:
+        _interned.clear()
+    return _interned.setdefault(term, term)
+
+def lowercase(term):
+    return term.lower()
+
+STOPWORDS = frozenset("""a an and are as at be but by for if in into is it 
+no not of on or such that the their then there these they this to was will 
+with""".split())
+
+class StopFilter(object):
+    """Drops stop words, which are not worth indexing or searching for."""
+    def __init__(self, stopwords=STOPWORDS):
+        self.stopwords = frozenset(stopwords)
+
+    def __call__(self, term):
+        if term in self.stopwords:
+            return None
+        return term
+
+def s_stem(term):
+    """
+    Harman's S stemmer, which only folds plurals.
+
+    >>> [s_stem(x) for x in ('trolls', 'ponies', 'boxes', 'shoes', 'glass')]
+    ['troll', 'pony', 'boxe', 'shoe', 'glass']
+    """
+    if term.endswith('ies') and not term.endswith(('eies', 'aies')):
+        return term[:-3] + 'y'
+    if term.endswith('es') and not term.endswith(('aes', 'ees', 'oes')):
+        return term[:-1]
+    if term.endswith('s') and not term.endswith(('us', 'ss')):
+        return term[:-1]
+    return term
+
+class Analyzer(object):
+    """
+    Turns field values into terms.  A regular expression splits a value 
+    into tokens, and each token is passed through filters in order: 
+    functions from a term to a term, or to None to drop it, such as 
+    lowercase, StopFilter() and s_stem.  Dropped tokens leave no gap in 
+    the token_ids.
+
+    The term for each distinct token is remembered, up to about 
+    cache_size of them, and terms are interned, so a word is normalized 
+    once and held once however often it is indexed or searched for.
+
+    >>> analyzer = Analyzer((lowercase, StopFilter(), s_stem))
+    >>> analyzer.tokenize("The Trolls of the Mountains")
+    ['troll', 'mountain']
+    >>> analyzer.tokenize_many(['Trolls', 'a troll'])
+    [['troll'], ['troll']]
+    """
+    def __init__(self, filters=(lowercase,), re_string=r'[\w\']+', 
+            cache_size=50000):
+        self.filters = tuple(filters)
+        self.re_string = re_string
+        self.cache_size = cache_size
+        self._setup()
+
+    def _setup(self):
+        self.tokens_re = re.compile(self.re_string)
+        # terms by token, '' for dropped tokens
+        self.terms = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['tokens_re'], state['terms']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._setup()
+
+    def normalize(self, token):
+        """Return the term for token, or None if a filter drops it."""
+        term = token
+        for term_filter in self.filters:
+            term = term_filter(term)
+            if term is None:
+                return None
+        return _intern(term)
 
     def tokenize(self, value):
-        tokens = self.tokens_re.findall(value)
-        if self.lower:
-            tokens = [x.lower() for x in tokens]
-        return tokens
+        return self.tokenize_many((value,))[0]
+
+    def tokenize_many(self, values):
+        """Return a list of the terms in each of values."""
+        findall = self.tokens_re.findall
+        terms = self.terms
+        get_term = terms.get
+        if len(terms) > self.cache_size:
+            terms.clear()
+        results = []
+        for value in values:
+            tokens = findall(value)
+            value_terms = map(get_term, tokens)
+            # only tokens not seen before are normalized one by one
+            if None in value_terms:
+                for position, token in enumerate(tokens):
+                    if value_terms[position] is None:
+                        value_terms[position] = terms[token] = \
+                                self.normalize(token) or ''
+            if '' in value_terms:
+                value_terms = [x for x in value_terms if x]
+            results.append(value_terms)
+        return results
+
+class Tokenizer(Analyzer):
+    """An Analyzer that lowercases tokens, if lower, and nothing else."""
+    def __init__(self, lower=True, re_string=r'[\w\']+'):
+        Analyzer.__init__(self, lower and (lowercase,) or (), re_string)
+        self.lower = lower
 
 class TokenizerNot(object):
     """A non-tokenizing tokenizer."""
     def tokenize(self, value):
-        return [value]
+        return [_intern(value)]
+
+    def tokenize_many(self, values):
+        return [[_intern(x)] for x in values]
+
+def _put_varint(buf, number):
+    """Append a non-negative integer to a bytearray as a varint."""
+    while number > 0x7f:
+        buf.append((number & 0x7f) | 0x80)
+        number >>= 7
+    buf.append(number)
+
+def _get_varint(buf, pos):
+    """Read a varint from a bytearray, returning (number, next_pos)."""
+    number = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        number |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return number, pos
+        shift += 7
+
+def _array_to_bytes(values):
+    """Little-endian bytes of an array('I'), for writing to segments."""
+    if sys.byteorder != 'little':
+        values = array('I', values)
+        values.byteswap()
+    return values.tostring()
+
+def _array_from_bytes(data):
+    values = array('I')
+    values.fromstring(data)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
 
-class TokenLocations(dict):
+def _following(token_ids, previous_token_ids, distance=1):
     """
-    TokenLocations is a dictionary of dictionaries of lists.  The keys for 
-    the outer dictionary are document IDs.  The keys for the inner 
-    dictionaries are field IDs (for multiple fields with the same name in a 
-    document).  The lists are token IDs, pointing to the position of each
-    token in a field.
+    Returns the token IDs that come exactly distance after one of the
+    previous token IDs.  Both lists are sorted, so this is one merge pass.
     """
-    def add_location(self, doc_id, field_id, token_id):
-        if doc_id in self:
-            field_ids = self[doc_id]
-            if field_id in field_ids:
-                field_ids[field_id].append(token_id)
-            else:
-                field_ids[field_id] = [token_id]
+    following = []
+    j = 0
+    previous_count = len(previous_token_ids)
+    for token_id in token_ids:
+        wanted = token_id - distance
+        while j < previous_count and previous_token_ids[j] < wanted:
+            j += 1
+        if j == previous_count:
+            break
+        if previous_token_ids[j] == wanted:
+            following.append(token_id)
+    return following
+
+def _in_sequence(position_lists, slop=0):
+    """
+    Returns True if one token ID can be picked from each sorted list so 
+    they run in order, each within slop + 1 positions of the one before.
+    """
+    first_token_ids = position_lists[0]
+    for position in first_token_ids:
+        for token_ids in position_lists[1:]:
+            i = bisect.bisect_right(token_ids, position)
+            if i == len(token_ids) or token_ids[i] > position + 1 + slop:
+                break
+            position = token_ids[i]
         else:
-            self[doc_id] = {field_id: [token_id]}
-        
+            return True
+    return False
+
+def _leapfrog(cursors):
+    """
+    Yields each document ID reached by every cursor, leaving all of the 
+    cursors on it.  The first cursor drives, so put the rarest first.
+    """
+    driver = cursors[0]
+    doc_id = driver.next_doc()
+    while doc_id is not None:
+        for cursor in cursors[1:]:
+            other_doc_id = cursor.advance(doc_id)
+            if other_doc_id != doc_id:
+                break
+        else:
+            yield doc_id
+            doc_id = driver.next_doc()
+            continue
+        if other_doc_id is None:
+            return
+        doc_id = driver.advance(other_doc_id)
+
+def _nearest(token_ids, previous_token_ids):
+    """
+    Returns the signed distance from each token ID to the nearest previous
+    token ID.  Both lists are sorted, so this is one merge pass.
+    """
+    distances = []
+    j = 0
+    last = len(previous_token_ids) - 1
+    for token_id in token_ids:
+        while j < last and previous_token_ids[j + 1] <= token_id:
+            j += 1
+        distance = token_id - previous_token_ids[j]
+        if j < last and previous_token_ids[j + 1] - token_id < abs(distance):
+            distance = token_id - previous_token_ids[j + 1]
+        distances.append(distance)
+    return distances
+
+class Locations(object):
+    """
+    Comparison methods shared by TokenLocations and Postings.  Both map 
+    document IDs to dictionaries of field IDs to sorted lists of token IDs
+    and provide a cursor() over their document IDs in order.  Documents 
+    are matched by leapfrogging the two cursors and token IDs by merging 
+    sorted lists, so the work grows with the number of locations rather 
+    than their product.
+    """
+    def intersect(self, previous_locations):
+        """
+        Yields (doc_id, field_ids, previous_field_ids) for each document in 
+        both self and previous_locations.
+        """
+        cursor = self.cursor()
+        previous_cursor = previous_locations.cursor()
+        for doc_id in _leapfrog([cursor, previous_cursor]):
+            yield doc_id, cursor.fields(), previous_cursor.fields()
+
+    def frequencies(self, doc_ids=None):
+        """
+        Yields (doc_id, frequency) for each document, or only for those in 
+        doc_ids, a sorted list, which the cursor seeks to in turn unless 
+        there are more of them than documents here.
+        """
+        cursor = self.cursor()
+        if doc_ids is None:
+            while cursor.next_doc() is not None:
+                yield cursor.doc_id, cursor.frequency()
+        elif len(doc_ids) > len(self):
+            wanted = set(doc_ids)
+            while cursor.next_doc() is not None:
+                if cursor.doc_id in wanted:
+                    yield cursor.doc_id, cursor.frequency()
+        else:
+            for doc_id in doc_ids:
+                found_doc_id = cursor.advance(doc_id)
+                if found_doc_id is None:
+                    break
+                if found_doc_id == doc_id:
+                    yield doc_id, cursor.frequency()
+
+    def _field_pairs(self, previous_locations):
+        for doc_id, field_ids, previous_field_ids in self.intersect(
+                previous_locations):
+            for field_id, token_ids in field_ids.iteritems():
+                previous_token_ids = previous_field_ids.get(field_id)
+                if previous_token_ids:
+                    yield doc_id, field_id, token_ids, previous_token_ids
+
     def compare(self, previous_locations, proximity_range=1):
         """
-        Returns close_locations and a list of all distances between 
-        compared locations.  Each location in close_locations is within 
-        the proximity_range of a previous location.
+        Returns close_locations and the distance from each compared 
+        location to its nearest previous location.  Each location in 
+        close_locations is within the proximity_range of a previous 
+        location, on either side.
         """
         close_locations = TokenLocations()
         distances = []
-        for doc_id in self:
-            if doc_id in previous_locations:
-                field_ids = self[doc_id]
-                previous_field_ids = previous_locations[doc_id]
-                for field_id in field_ids:
-                    if field_id in previous_field_ids:
-                        token_ids = field_ids[field_id]
-                        previous_token_ids = previous_field_ids[field_id]
-                        for token_id in token_ids:
-                            for previous_token_id in previous_token_ids:
-                                distance = token_id - previous_token_id
-                                if distance <= proximity_range:
-                                    close_locations.add_location(doc_id, 
-                                            field_id, token_id)
-                                distances.append(distance)
+        for doc_id, field_id, token_ids, previous_token_ids in \
+                self._field_pairs(previous_locations):
+            nearest = _nearest(token_ids, previous_token_ids)
+            for token_id, distance in zip(token_ids, nearest):
+                if -proximity_range <= distance <= proximity_range:
+                    close_locations.add_location(doc_id, field_id, token_id)
+            distances.extend(nearest)
         return close_locations, distances
 
     def get_consecutive(self, previous_locations):
@@ -141,39 +692,698 @@ class TokenLocations(dict):
         and complex word searches.
         """
         consecutive_locations = TokenLocations()
-        for doc_id in self:
-            if doc_id in previous_locations:
-                field_ids = self[doc_id]
-                previous_field_ids = previous_locations[doc_id]
-                for field_id in field_ids:
-                    if field_id in previous_field_ids:
-                        token_ids = field_ids[field_id]
-                        previous_token_ids = previous_field_ids[field_id]
-                        for token_id in token_ids:
-                            if token_id in previous_token_ids:
-                                consecutive_locations.add_location(doc_id, 
-                                        field_id, token_id)
+        for doc_id, field_id, token_ids, previous_token_ids in \
+                self._field_pairs(previous_locations):
+            following = _following(token_ids, previous_token_ids)
+            if following:
+                consecutive_locations.setdefault(doc_id, {})[field_id] = \
+                        following
         return consecutive_locations
 
     def get_distances(self, previous_locations):
         """
-        Returns a list of integer distances from each location in 
-        previous_locations to each location in self.
+        Returns a list of integer distances from each location in self to
+        the nearest location in previous_locations.
         """
         distances = []
-        for doc_id in self:
-            if doc_id in previous_locations:
-                field_ids = self[doc_id]
-                previous_field_ids = previous_locations[doc_id]
-                for field_id in field_ids:
-                    if field_id in previous_field_ids:
-                        token_ids = field_ids[field_id]
-                        previous_token_ids = previous_field_ids[field_id]
-                        for token_id in token_ids:
-                            for previous_token_id in previous_token_ids:
-                                distances.append(token_id - previous_token_id)
+        for doc_id, field_id, token_ids, previous_token_ids in \
+                self._field_pairs(previous_locations):
+            distances.extend(_nearest(token_ids, previous_token_ids))
         return distances
 
+class TokenLocations(Locations, dict):
+    """
+    TokenLocations is a dictionary of dictionaries of lists.  The keys for 
+    the outer dictionary are document IDs.  The keys for the inner 
+    dictionaries are field IDs (for multiple fields with the same name in a 
+    document).  The lists are token IDs, pointing to the position of each
+    token in a field.
+    """
+    def add_location(self, doc_id, field_id, token_id):
+        if doc_id in self:
+            field_ids = self[doc_id]
+            if field_id in field_ids:
+                field_ids[field_id].append(token_id)
+            else:
+                field_ids[field_id] = [token_id]
+        else:
+            self[doc_id] = {field_id: [token_id]}
+
+    def cursor(self):
+        return LocationsCursor(self)
+
+class LocationsCursor(object):
+    """Walks the document IDs of a TokenLocations in order."""
+    def __init__(self, locations):
+        self.locations = locations
+        self.doc_ids = sorted(locations)
+        self.i = -1
+        self.doc_id = None
+
+    def next_doc(self):
+        self.i += 1
+        if self.i < len(self.doc_ids):
+            self.doc_id = self.doc_ids[self.i]
+        else:
+            self.doc_id = None
+        return self.doc_id
+
+    def advance(self, target):
+        """Move to the first document ID at or after target."""
+        if self.doc_id is not None and self.doc_id >= target:
+            return self.doc_id
+        self.i = bisect.bisect_left(self.doc_ids, target, max(self.i, 0)) - 1
+        return self.next_doc()
+
+    def fields(self):
+        return self.locations[self.doc_id]
+
+    def frequency(self):
+        return sum(len(x) for x in self.locations[self.doc_id].itervalues())
+
+# postings record a skip pointer every SKIP_INTERVAL documents
+SKIP_INTERVAL = 32
+
+class Postings(Locations):
+    """
+    The locations of one token in one field, packed into a byte string 
+    rather than nested dictionaries.  Each document is a run of varints:
+
+        doc_id delta, frequency, payload length, payload
+
+    and the payload is, for each field ID, the field ID, the number of 
+    token IDs and the delta-encoded token IDs.  The payload length lets 
+    readers step over documents without decoding their token IDs, and 
+    every SKIP_INTERVAL documents a skip pointer records the doc ID 
+    before and the offset of the next entry, so cursors can jump ahead in
+    long postings.
+
+    Postings accumulate in a bytearray while indexing and freeze() packs 
+    them into a str for searching and pickling.  Reading works in either 
+    state, and adding to frozen postings thaws them again.  Postings read 
+    like a TokenLocations dictionary, decoded on the fly.
+
+    >>> p = Postings()
+    >>> p.add_document(3, [(0, [1, 4])])
+    >>> p.add_document(7, [(0, [0]), (2, [5])])
+    >>> p.freeze()
+    >>> len(p), list(p), p[7]
+    (2, [3, 7], {0: [0], 2: [5]})
+    """
+    __slots__ = ('data', 'doc_count', 'last_doc_id', 'skip_doc_ids', 
+            'skip_offsets')
+
+    def __init__(self):
+        self.data = bytearray()
+        self.doc_count = 0
+        self.last_doc_id = 0
+        self.skip_doc_ids = None
+        self.skip_offsets = None
+
+    @classmethod
+    def from_data(cls, data, doc_count, last_doc_id, skip_doc_ids=None, 
+            skip_offsets=None):
+        """Wrap already encoded postings, such as a slice of a segment."""
+        postings = cls.__new__(cls)
+        postings.data = data
+        postings.doc_count = doc_count
+        postings.last_doc_id = last_doc_id
+        postings.skip_doc_ids = skip_doc_ids
+        postings.skip_offsets = skip_offsets
+        return postings
+
+    def __getstate__(self):
+        self.freeze()
+        return (self.data, self.doc_count, self.last_doc_id, 
+                self.skip_doc_ids, self.skip_offsets)
+
+    def __setstate__(self, state):
+        (self.data, self.doc_count, self.last_doc_id, self.skip_doc_ids, 
+                self.skip_offsets) = state
+
+    def add_document(self, doc_id, field_positions):
+        """
+        Append the locations of this token in one document.  field_positions
+        is a list of (field_id, token_ids) pairs in field ID order, and 
+        documents must be added in increasing doc_id order.
+        """
+        payload = bytearray()
+        frequency = 0
+        for field_id, token_ids in field_positions:
+            _put_varint(payload, field_id)
+            _put_varint(payload, len(token_ids))
+            previous_token_id = 0
+            for token_id in token_ids:
+                _put_varint(payload, token_id - previous_token_id)
+                previous_token_id = token_id
+            frequency += len(token_ids)
+        self._append(doc_id, frequency, payload)
+
+    def _append(self, doc_id, frequency, payload):
+        if self.doc_count and doc_id <= self.last_doc_id:
+            raise IndexException, \
+                "Document %s added out of order to postings." % doc_id
+        if not isinstance(self.data, bytearray):
+            self.data = bytearray(self.data)
+        if self.doc_count and not self.doc_count % SKIP_INTERVAL:
+            if self.skip_doc_ids is None:
+                self.skip_doc_ids = array('I')
+                self.skip_offsets = array('I')
+            self.skip_doc_ids.append(self.last_doc_id)
+            self.skip_offsets.append(len(self.data))
+        _put_varint(self.data, doc_id - self.last_doc_id)
+        _put_varint(self.data, frequency)
+        _put_varint(self.data, len(payload))
+        self.data.extend(payload)
+        self.last_doc_id = doc_id
+        self.doc_count += 1
+
+    def freeze(self):
+        """Pack accumulated postings into an immutable str."""
+        if isinstance(self.data, bytearray):
+            self.data = bytes(self.data)
+
+    def without(self, doc_ids):
+        """Returns a copy of these postings leaving out doc_ids."""
+        postings = Postings()
+        for doc_id, frequency, buf, start, end in self.entries():
+            if doc_id not in doc_ids:
+                postings._append(doc_id, frequency, buf[start:end])
+        postings.freeze()
+        return postings
+
+    def extend(self, other):
+        """
+        Append postings whose doc IDs all come after these.  Only the first
+        doc ID delta of other is rewritten; the rest is copied, and a skip 
+        pointer marks where it starts.
+        """
+        if not other.doc_count:
+            return
+        if not isinstance(self.data, bytearray):
+            self.data = bytearray(self.data)
+        first_doc_id, pos = _get_varint(bytearray(other.data[:10]), 0)
+        if self.skip_doc_ids is None:
+            self.skip_doc_ids = array('I')
+            self.skip_offsets = array('I')
+        if self.doc_count:
+            if first_doc_id <= self.last_doc_id:
+                raise IndexException, "Postings overlap."
+            self.skip_doc_ids.append(self.last_doc_id)
+            self.skip_offsets.append(len(self.data))
+        _put_varint(self.data, first_doc_id - self.last_doc_id)
+        # offsets within other move by where it starts, less any change in
+        # the size of its first delta
+        shift = len(self.data) - pos
+        self.data.extend(other.data[pos:])
+        if other.skip_doc_ids:
+            self.skip_doc_ids.extend(other.skip_doc_ids)
+            self.skip_offsets.extend(x + shift for x in other.skip_offsets)
+        if not self.skip_doc_ids:
+            self.skip_doc_ids = self.skip_offsets = None
+        self.doc_count += other.doc_count
+        self.last_doc_id = other.last_doc_id
+
+    @classmethod
+    def concat(cls, parts):
+        """
+        Join postings covering ascending, separate ranges of doc IDs, such
+        as those of one token in successive segments.
+        """
+        parts = [x for x in parts if x.doc_count]
+        if len(parts) == 1:
+            return parts[0]
+        postings = cls()
+        for part in parts:
+            postings.extend(part)
+        postings.freeze()
+        return postings
+
+    def cursor(self):
+        return PostingsCursor(self)
+
+    def entries(self):
+        """
+        Yields (doc_id, frequency, buf, start, end) for each document, where
+        buf[start:end] is the undecoded payload.
+        """
+        cursor = self.cursor()
+        while cursor.next_doc() is not None:
+            yield (cursor.doc_id, cursor.doc_frequency, cursor.buf, 
+                    cursor.start, cursor.end)
+
+    @staticmethod
+    def decode_payload(buf, pos, end):
+        """Decode a payload into a dictionary of field IDs to token IDs."""
+        field_ids = {}
+        while pos < end:
+            field_id, pos = _get_varint(buf, pos)
+            count, pos = _get_varint(buf, pos)
+            token_ids = []
+            token_id = 0
+            for i in xrange(count):
+                delta, pos = _get_varint(buf, pos)
+                token_id += delta
+                token_ids.append(token_id)
+            field_ids[field_id] = token_ids
+        return field_ids
+
+    def iteritems(self):
+        for doc_id, frequency, buf, start, end in self.entries():
+            yield doc_id, self.decode_payload(buf, start, end)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __iter__(self):
+        for entry in self.entries():
+            yield entry[0]
+
+    def keys(self):
+        return list(self)
+
+    def __len__(self):
+        return self.doc_count
+
+    def get(self, doc_id, default=None):
+        cursor = self.cursor()
+        if cursor.advance(doc_id) == doc_id:
+            return cursor.fields()
+        return default
+
+    def __getitem__(self, doc_id):
+        field_ids = self.get(doc_id)
+        if field_ids is None:
+            raise KeyError(doc_id)
+        return field_ids
+
+    def __contains__(self, doc_id):
+        return self.cursor().advance(doc_id) == doc_id
+
+class PostingsCursor(object):
+    """
+    Walks the documents of a Postings in order.  advance() follows skip 
+    pointers, so seeking in long postings does not decode every entry.
+    """
+    def __init__(self, postings):
+        self.postings = postings
+        self.buf = postings.data
+        if not isinstance(self.buf, bytearray):
+            self.buf = bytearray(self.buf)
+        self.pos = 0
+        self.base_doc_id = 0
+        self.doc_id = None
+        self.doc_frequency = 0
+        self.start = self.end = 0
+
+    def next_doc(self):
+        buf = self.buf
+        pos = self.pos
+        if pos >= len(buf):
+            self.doc_id = None
+            return None
+        delta, pos = _get_varint(buf, pos)
+        self.doc_frequency, pos = _get_varint(buf, pos)
+        length, pos = _get_varint(buf, pos)
+        self.base_doc_id += delta
+        self.doc_id = self.base_doc_id
+        self.start = pos
+        self.pos = self.end = pos + length
+        return self.doc_id
+
+    def advance(self, target):
+        """Move to the first document ID at or after target."""
+        if self.doc_id is not None and self.doc_id >= target:
+            return self.doc_id
+        skip_doc_ids = self.postings.skip_doc_ids
+        if skip_doc_ids:
+            i = bisect.bisect_left(skip_doc_ids, target) - 1
+            if i >= 0 and self.postings.skip_offsets[i] > self.pos:
+                self.pos = self.postings.skip_offsets[i]
+                self.base_doc_id = skip_doc_ids[i]
+        doc_id = self.next_doc()
+        while doc_id is not None and doc_id < target:
+            doc_id = self.next_doc()
+        return doc_id
+
+    def fields(self):
+        return Postings.decode_payload(self.buf, self.start, self.end)
+
+    def frequency(self):
+        """The number of token IDs in this document, read without decoding."""
+        return self.doc_frequency
+
+# the set bits of each byte value
+_BYTE_BITS = [tuple(x for x in xrange(8) if value & (1 << x)) 
+        for value in xrange(256)]
+
+class Bitmap(object):
+    """
+    A set of document IDs kept as one bit each in a bytearray, such as the
+    deleted documents of an index or those matching part of a query.  &,
+    | and - return new bitmaps, computed a machine word at a time by 
+    treating the bits as one long integer.
+
+    >>> deleted = Bitmap()
+    >>> deleted.add(3)
+    >>> deleted.add(12)
+    >>> 12 in deleted, 4 in deleted, len(deleted), list(deleted)
+    (True, False, 2, [3, 12])
+    >>> found = Bitmap()
+    >>> found.update([1, 3, 40])
+    >>> list(found & deleted), list(found | deleted), list(found - deleted)
+    ([3], [1, 3, 12, 40], [1, 40])
+    """
+    __slots__ = ('bits', 'count')
+
+    def __init__(self, data=''):
+        self.bits = bytearray(data)
+        self.count = sum(bin(x).count('1') for x in self.bits if x)
+
+    def add(self, doc_id):
+        byte = doc_id >> 3
+        if byte >= len(self.bits):
+            self.bits.extend(bytearray(byte + 1 - len(self.bits)))
+        mask = 1 << (doc_id & 7)
+        if not self.bits[byte] & mask:
+            self.bits[byte] |= mask
+            self.count += 1
+
+    def update(self, doc_ids):
+        bits = self.bits
+        for doc_id in doc_ids:
+            byte = doc_id >> 3
+            if byte >= len(bits):
+                bits.extend(bytearray(byte + 1 - len(bits)))
+            mask = 1 << (doc_id & 7)
+            if not bits[byte] & mask:
+                bits[byte] |= mask
+                self.count += 1
+
+    def discard(self, doc_id):
+        byte = doc_id >> 3
+        mask = 1 << (doc_id & 7)
+        if byte < len(self.bits) and self.bits[byte] & mask:
+            self.bits[byte] &= ~mask
+            self.count -= 1
+
+    def __contains__(self, doc_id):
+        byte = doc_id >> 3
+        return (byte < len(self.bits) and 
+                bool(self.bits[byte] & (1 << (doc_id & 7))))
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        byte_bits = _BYTE_BITS
+        for byte, bits in enumerate(self.bits):
+            if bits:
+                base = byte << 3
+                for bit in byte_bits[bits]:
+                    yield base | bit
+
+    def tostring(self):
+        return bytes(self.bits)
+
+    def _long(self):
+        """The bits as one number, in which doc ID n is bit n."""
+        return long(bytes(self.bits[::-1]).encode('hex') or '0', 16)
+
+    @classmethod
+    def _from_long(cls, number):
+        bitmap = cls.__new__(cls)
+        digits = '%x' % number
+        if len(digits) & 1:
+            digits = '0' + digits
+        bitmap.bits = bytearray(digits.decode('hex')[::-1])
+        bitmap.count = bin(number).count('1')
+        return bitmap
+
+    def __and__(self, other):
+        return Bitmap._from_long(self._long() & other._long())
+
+    def __or__(self, other):
+        return Bitmap._from_long(self._long() | other._long())
+
+    def __sub__(self, other):
+        return Bitmap._from_long(self._long() & ~other._long())
+
+def _edit_distance(a, b, limit):
+    """
+    The number of insertions, deletions, substitutions, and swaps of 
+    neighbouring characters that turn a into b, or limit + 1 if it is 
+    more than limit.
+
+    >>> _edit_distance('troll', 'trlol', 2), _edit_distance('troll', 'x', 2)
+    (1, 3)
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    before = None
+    previous = range(len(b) + 1)
+    for i, a_char in enumerate(a):
+        current = [i + 1]
+        for j, b_char in enumerate(b):
+            distance = min(previous[j + 1] + 1, current[j] + 1, 
+                    previous[j] + (a_char != b_char))
+            if (i and j and a_char == b[j - 1] and a[i - 1] == b_char and 
+                    before[j - 1] + 1 < distance):
+                distance = before[j - 1] + 1
+            current.append(distance)
+        if min(current) > limit:
+            return limit + 1
+        before, previous = previous, current
+    return min(previous[-1], limit + 1)
+
+def _trigrams(term):
+    padded = u'$%s$' % term
+    return set(padded[i:i + 3] for i in xrange(len(padded) - 2))
+
+class NGramIndex(object):
+    """
+    The tokens of a field by the trigrams of their characters, for 
+    finding tokens close to a misspelled one without comparing it to 
+    every token.  Each edit changes at most four trigrams, so a token 
+    within n edits of a term shares all but 4n of the term's trigrams; 
+    only the tokens sharing the most are measured.  A term too short for
+    that to promise a shared trigram is also measured against the tokens 
+    of up to SHORT_TOKEN characters near its length, and otherwise only 
+    against tokens sharing one, which may miss a few.
+
+    Saved segments keep the same tables as SegmentNGrams; closest_tokens
+    searches any number of either.
+    """
+    # token numbers are in the order tokens were added, not token order
+    ordered = False
+
+    def __init__(self, tokens=()):
+        # token bytes by number, and their lengths in characters
+        self.tokens = []
+        self.lengths = array('I')
+        self.token_ids = {}
+        self.grams = {}
+        # numbers of short tokens by length
+        self.short_tokens = {}
+        for token in tokens:
+            self.add(token)
+
+    def add(self, token):
+        token = _term_bytes(token)
+        if token in self.token_ids:
+            return
+        token_id = self.token_ids[token] = len(self.tokens)
+        chars = token.decode('utf-8', 'replace')
+        self.tokens.append(token)
+        self.lengths.append(len(chars))
+        if len(chars) <= SHORT_TOKEN:
+            self.short_tokens.setdefault(len(chars), 
+                    array('I')).append(token_id)
+        for gram in _trigrams(chars):
+            if gram in self.grams:
+                self.grams[gram].append(token_id)
+            else:
+                self.grams[gram] = array('I', [token_id])
+
+    def gram_tokens(self, gram):
+        """The numbers of the tokens with the trigram gram."""
+        return self.grams.get(gram, ())
+
+    def short(self, length):
+        """The numbers of the short tokens of length characters."""
+        return self.short_tokens.get(length, ())
+
+    def token(self, token_id):
+        return self.tokens[token_id]
+
+    def char_lengths(self):
+        """The length in characters of each token, by number."""
+        return self.lengths
+
+    def closest(self, term, max_edits=1, limit=MAX_FUZZY_CANDIDATES):
+        """
+        Returns a sorted list of (distance, token) for tokens within 
+        max_edits of term, measuring at most limit candidates.
+        """
+        return closest_tokens([self], term, max_edits, limit)
+
+def closest_tokens(ngram_indexes, term, max_edits=1, 
+        limit=MAX_FUZZY_CANDIDATES):
+    """
+    Returns a sorted list of (distance, token) for the tokens of any of 
+    ngram_indexes within max_edits of term, measuring at most limit 
+    candidates.
+    """
+    chars = _term_bytes(term).decode('utf-8', 'replace')
+    grams = _trigrams(chars)
+    least_shared = len(grams) - 4 * max_edits
+    # a token has the same trigrams wherever it is, so counts found for 
+    # it in several indexes agree
+    shared = {}
+    for ngrams in ngram_indexes:
+        counts = {}
+        for gram in grams:
+            for token_id in ngrams.gram_tokens(gram):
+                counts[token_id] = counts.get(token_id, 0) + 1
+        if least_shared < 1:
+            for length in xrange(len(chars) - max_edits, 
+                    len(chars) + max_edits + 1):
+                for token_id in ngrams.short(length):
+                    counts.setdefault(token_id, 0)
+        lengths = ngrams.char_lengths()
+        # tokens with too many characters more or less can't be close
+        close = ((count, token_id) for token_id, count in counts.iteritems()
+                if count >= least_shared and 
+                abs(lengths[token_id] - len(chars)) <= max_edits)
+        if ngrams.ordered:
+            # numbers sort as their tokens do, so only the best are read;
+            # small numbers come out of counts roughly in order, and 
+            # reversed, few of them displace one already in the heap
+            close = heapq.nlargest(limit, reversed(list(close)))
+        for count, token_id in close:
+            shared[ngrams.token(token_id)] = count
+    candidates = heapq.nlargest(limit, ((count, token) 
+            for token, count in shared.iteritems()))
+    found = []
+    for count, token in candidates:
+        distance = _edit_distance(chars, token.decode('utf-8', 'replace'), 
+                max_edits)
+        if distance <= max_edits:
+            found.append((distance, token))
+    found.sort()
+    return found
+
+class TermCounts(object):
+    """
+    The number of documents holding each of a field's tokens, kept in 
+    buckets by count along with a sorted list of the counts in use, so 
+    the most frequent tokens are found without sorting every token.
+
+    >>> counts = TermCounts({'troll': 2, 'mountain': 1, 'baby': 1})
+    >>> counts.add('baby', 2)
+    >>> counts.top(2)
+    [('baby', 3), ('troll', 2)]
+    """
+    def __init__(self, counts=None):
+        self.counts = {}
+        # tokens by count, and the counts in ascending order
+        self.buckets = {}
+        self.levels = []
+        if counts:
+            self.counts.update(counts)
+            for token, count in self.counts.iteritems():
+                if count in self.buckets:
+                    self.buckets[count].add(token)
+                else:
+                    self.buckets[count] = set([token])
+            self.levels = sorted(self.buckets)
+
+    def add(self, token, count=1):
+        """Count token in count more documents."""
+        old_count = self.counts.get(token, 0)
+        new_count = self.counts[token] = old_count + count
+        if old_count:
+            bucket = self.buckets[old_count]
+            bucket.discard(token)
+            if not bucket:
+                del self.buckets[old_count]
+                del self.levels[bisect.bisect_left(self.levels, old_count)]
+        if new_count in self.buckets:
+            self.buckets[new_count].add(token)
+        else:
+            self.buckets[new_count] = set([token])
+            bisect.insort(self.levels, new_count)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def top(self, n=None):
+        """
+        Returns (token, count) for the n most frequent tokens, or all of 
+        them, by count and then token.
+        """
+        if n is None:
+            n = len(self.counts)
+        found = []
+        for count in reversed(self.levels):
+            wanted = n - len(found)
+            if wanted <= 0:
+                break
+            bucket = self.buckets[count]
+            if len(bucket) > wanted:
+                tokens = heapq.nsmallest(wanted, bucket)
+            else:
+                tokens = sorted(bucket)
+            found.extend((token, count) for token in tokens)
+        return found
+
+def _top_terms(sources, n, max_reads):
+    """
+    Returns (term, count) for the n terms with the most documents across 
+    sources, by count and then term, or None if that takes more than 
+    max_reads terms.  Each source yields its own (term, count) in that 
+    order from iter_top and looks a term up with doc_count.  They are 
+    read in turn, each term's counts summed as it is first met, only 
+    until no term further down any of them could still be among the n 
+    (the threshold algorithm), so one source takes n + 1.  Sources with 
+    many terms at the same counts may have to be read to the end.
+    """
+    if n <= 0:
+        return []
+    reads = 0
+    iterators = [x.iter_top() for x in sources]
+    heads = [next(x, None) for x in iterators]
+    seen = set()
+    # (-count, term) of the best n so far, best first
+    best = []
+    while True:
+        active = [x for x in heads if x is not None]
+        if not active:
+            break
+        if len(best) == n:
+            # an unseen term can at most have every source's next count, 
+            # and only then comes after every source's next term
+            threshold = sum(count for term, count in active)
+            count, term = -best[-1][0], best[-1][1]
+            if count > threshold or (count == threshold and 
+                    max(x[0] for x in active) >= term):
+                break
+        reads += len(active)
+        if reads > max_reads:
+            return None
+        for i, head in enumerate(heads):
+            if head is None:
+                continue
+            heads[i] = next(iterators[i], None)
+            term = head[0]
+            if term in seen:
+                continue
+            seen.add(term)
+            count = sum(x.doc_count(term) for x in sources)
+            bisect.insort(best, (-count, term))
+            del best[n:]
+    return [(term, -count) for count, term in best]
+
 class Field(object):
     """
     For tokens across the index:
@@ -206,149 +1416,991 @@ class Field(object):
             self.tokenizer = tokenizer
         else:
             self.tokenizer = TokenizerNot()
+        # postings of documents added since the index was saved, by the 
+        # UTF-8 bytes of each token, as saved segments key them
         self.tokens = {}
+        # the keys of tokens, sorted when terms are listed
+        self.sorted_tokens = []
+        # an NGramIndex of the tokens added since the index was saved, 
+        # made at the first fuzzy search
+        self.ngrams = None
+        # TermCounts of every token, made when they are first listed if 
+        # the saved segments' lists by count won't do
+        self.term_counts = None
+        # term dictionaries of the index's saved segments, oldest first,
+        # and the SegmentNGrams of their terms
+        self.segment_terms = []
+        self.segment_ngrams = []
+        # token counts by doc_id, for length norms in scoring
+        self.lengths = array('I')
+        self.total_length = 0
+        self.document_count = 0
+
+    def config(self):
+        """The field's settings and statistics, without its postings."""
+        config = dict(self.__dict__)
+        del config['tokens'], config['sorted_tokens'], config['ngrams'], \
+                config['term_counts'], config['lengths'], \
+                config['segment_terms'], config['segment_ngrams']
+        return config
+
+    def copy(self):
+        """Returns a Field with the same settings and nothing indexed."""
+        field = Field.__new__(Field)
+        field.__dict__.update(self.config())
+        field.tokens = {}
+        field.sorted_tokens = []
+        field.ngrams = None
+        field.term_counts = None
+        field.segment_terms = []
+        field.segment_ngrams = []
+        field.lengths = array('I')
+        field.total_length = 0
+        field.document_count = 0
+        return field
+
+    def merge(self, tokens, first_doc_id, lengths, total_length, 
+            document_count):
+        """
+        Add postings and statistics built by a copy of this field for 
+        documents numbered from first_doc_id, after any already added.
+        """
+        for token, postings in tokens.iteritems():
+            if token in self.tokens:
+                self.tokens[token].extend(postings)
+            else:
+                self.tokens[token] = postings
+                if self.ngrams is not None:
+                    self.ngrams.add(token)
+            if self.term_counts is not None:
+                self.term_counts.add(token, len(postings))
+        self.thaw()
+        if len(self.lengths) < first_doc_id:
+            self.lengths.fromlist([0] * (first_doc_id - len(self.lengths)))
+        del self.lengths[first_doc_id:]
+        self.lengths.extend(lengths)
+        self.total_length += total_length
+        self.document_count += document_count
+
+    def get(self, token, default=None):
+        """Returns the postings for token across every segment."""
+        parts = [x.get(token) for x in self.segment_terms]
+        parts.append(self.tokens.get(_term_bytes(token)))
+        parts = [x for x in parts if x is not None]
+        if not parts:
+            return default
+        return Postings.concat(parts)
 
     def __getitem__(self, key):
-        return self.tokens[key]
+        postings = self.get(key)
+        if postings is None:
+            raise KeyError(key)
+        return postings
+
+    def __contains__(self, token):
+        if _term_bytes(token) in self.tokens:
+            return True
+        for terms in self.segment_terms:
+            if token in terms:
+                return True
+        return False
 
     def __iter__(self):
-        for token in self.tokens:
-            yield token
+        """Yields each token once, in order of their UTF-8 bytes."""
+        return self.iter_range('')
+
+    def _sorted_tokens(self):
+        # tokens are only ever added, so a change in number means new ones
+        if len(self.sorted_tokens) != len(self.tokens):
+            self.sorted_tokens = sorted(self.tokens)
+        return self.sorted_tokens
+
+    def iter_range(self, start, stop=None):
+        """
+        Yields each token from start up to, but not including, stop, in 
+        order of their UTF-8 bytes.  Each term dictionary is binary 
+        searched for start, so this takes O(log n) plus the tokens found.
+        Tokens are keyed by those bytes whether saved or not.
+
+        >>> index = Index(fields=(Field('title', 
+        ...         tokenizer=Analyzer(re_string=r'(?u)\w+')), 
+        ...         Field('k', tokenizer=None)), cache=False)
+        >>> index.add(Document(title=u'Caf\\xe9 cr\\xe8me', k=u'Caf\\xe9'))
+        >>> list(index.fields['title'].iter_range(u'cr\\xe8'))
+        ['cr\\xc3\\xa8me']
+        >>> [index.search(x).total for x in (u'caf*', u'title:cr\\xe8*', 
+        ...         u'title:[cr\\xe8 TO d]', u'k:Caf*', 
+        ...         u'"caf\\xe9 cr\\xe8me"')]
+        [1, 1, 1, 1, 1]
+        """
+        start = _term_bytes(start)
+        if stop is not None:
+            stop = _term_bytes(stop)
+        sources = [x.iter_range(start, stop) for x in self.segment_terms]
+        sorted_tokens = self._sorted_tokens()
+        if stop is None:
+            end = len(sorted_tokens)
+        else:
+            end = bisect.bisect_left(sorted_tokens, stop)
+        sources.append(iter(sorted_tokens[
+                bisect.bisect_left(sorted_tokens, start):end]))
+        previous_token = None
+        for token in heapq.merge(*sources):
+            if token != previous_token:
+                yield token
+                previous_token = token
+
+    def range_terms(self, low=None, high=None):
+        """Yields the tokens from low to high inclusive; None is open."""
+        if high is not None:
+            # the next string after high
+            high = _term_bytes(high) + '\x00'
+        return self.iter_range(low or '', high)
+
+    def _pattern_term(self, pattern):
+        # patterns are matched against tokens as the tokenizer leaves them
+        if lowercase in getattr(self.tokenizer, 'filters', ()):
+            pattern = pattern.lower()
+        return _term_bytes(pattern)
+
+    def match_terms(self, pattern, limit=None):
+        """
+        Yields up to limit tokens matching a pattern where * stands for 
+        any characters and ? for one.  Only tokens starting with the part
+        of the pattern before the first wildcard are looked at.
+        """
+        pattern = self._pattern_term(pattern)
+        prefix = re.split(r'[*?]', pattern, 1)[0]
+        pattern_re = _pattern_re(pattern)
+        count = 0
+        for token in self.iter_range(prefix):
+            if not token.startswith(prefix) or count == limit:
+                break
+            if pattern_re.match(token):
+                count += 1
+                yield token
+
+    def fuzzy_terms(self, term, max_edits=1):
+        """
+        Returns a sorted list of (distance, token) for the tokens within 
+        max_edits of term, closest first.  Saved segments hold the 
+        trigrams of their terms, so only tokens added since are indexed 
+        here.
+
+        >>> index = Index(fields=(Field('title'),), cache=False)
+        >>> index.add(Document(title='Troll bridge'))
+        >>> index.save('index')
+        >>> index.add(Document(title='Trolls'))
+        >>> index.fields['title'].fuzzy_terms('trol', 2)
+        [(1, 'troll'), (2, 'trolls')]
+        >>> index = Index(fields=(Field('title', 
+        ...         tokenizer=Analyzer(re_string=r'(?u)\w+')), 
+        ...         Field('k', tokenizer=None)), cache=False)
+        >>> index.add(Document(title=u'Caf\\xe9', k=u'Caf\\xe9'))
+        >>> index.fields['k'].fuzzy_terms(u'Caf\\xe8')
+        [(1, 'Caf\\xc3\\xa9')]
+        >>> [index.search(x).total for x in (u'caf\\xe8~1', u'k:Caf\\xe8~1')]
+        [1, 1]
+        """
+        if self.ngrams is None:
+            self.ngrams = NGramIndex(self.tokens)
+        return closest_tokens(self.segment_ngrams + [self.ngrams], term, 
+                max_edits)
+
+    def terms_documents(self, terms):
+        """The set of IDs of documents with any of the tokens."""
+        doc_ids = set()
+        for token in terms:
+            doc_ids.update(self[token])
+        return doc_ids
+
+    def iter_postings(self, deleted=()):
+        """Yields (token, postings) in token order, leaving out deleted."""
+        for token in self:
+            postings = self[token]
+            if deleted:
+                postings = postings.without(deleted)
+            if postings.doc_count:
+                yield token, postings
 
     def __str__(self):
         return self.name
 
     def add(self, field_value, document_id):
+        self.thaw()
         if hasattr(field_value, '__iter__'):
             field_values = field_value
         else:
             field_values = [field_value]
-        for field_id, field_value in enumerate(field_values):
-            token_values = self.tokenizer.tokenize(field_value)
+        # gather the document's locations for each token first, so every 
+        # posting gets a single entry for this document
+        locations = {}
+        for field_id, token_values in enumerate(
+                self.tokenizer.tokenize_many(field_values)):
             for token_id, value in enumerate(token_values):
-                if value in self.tokens:
-                    document_ids = self.tokens[value]
-                    if document_id in document_ids:
-                        field_ids = document_ids[document_id]
-                        if field_id in field_ids:
-                            field_ids[field_id].append(token_id)
-                        else:
-                            field_ids[field_id] = [token_id]
+                if value in locations:
+                    field_positions = locations[value]
+                    if field_positions[-1][0] == field_id:
+                        field_positions[-1][1].append(token_id)
                     else:
-                        document_ids[document_id] = {field_id: [token_id]}
+                        field_positions.append((field_id, [token_id]))
                 else:
-                    self.tokens[value] = {document_id: {field_id: [token_id]}}
-                        
-    def get_token_list(self):
-        """Get a list of tokens, sorted by popularity."""
-        decorated_token_list = [(-len(self.tokens[x]), x) for x in self.tokens]
-        decorated_token_list.sort()
-        return [(x[1], self.tokens[x[1]]) for x in decorated_token_list]
+                    locations[value] = [(field_id, [token_id])]
+        length = 0
+        for value, field_positions in locations.iteritems():
+            value = _term_bytes(value)
+            if value in self.tokens:
+                postings = self.tokens[value]
+            else:
+                postings = self.tokens[value] = Postings()
+                if self.ngrams is not None:
+                    self.ngrams.add(value)
+            postings.add_document(document_id, field_positions)
+            if self.term_counts is not None:
+                self.term_counts.add(value)
+            for field_id, token_ids in field_positions:
+                length += len(token_ids)
+        if len(self.lengths) <= document_id:
+            self.lengths.fromlist([0] * (document_id + 1 - len(self.lengths)))
+        if length:
+            if not self.lengths[document_id]:
+                self.document_count += 1
+            self.lengths[document_id] += length
+            self.total_length += length
+
+    def remove(self, document_id):
+        """Take a deleted document out of the length statistics."""
+        if document_id < len(self.lengths) and self.lengths[document_id]:
+            self.thaw()
+            self.total_length -= self.lengths[document_id]
+            self.document_count -= 1
+            self.lengths[document_id] = 0
+
+    def average_length(self):
+        if not self.document_count:
+            return 0.0
+        return self.total_length / float(self.document_count)
+
+    def phrase_documents(self, tokens, slop=0):
+        """
+        Yields the IDs of documents with tokens in order in one value of 
+        this field, each within slop positions of the one before.  Postings
+        are intersected rarest first, only documents holding every token 
+        are decoded, and each stops being checked at its first match.
+        """
+        if len(tokens) == 1:
+            # no positions to check
+            token_postings = self.get(tokens[0])
+            if token_postings is not None:
+                for doc_id in token_postings:
+                    yield doc_id
+            return
+        unique_tokens = list(set(tokens))
+        postings = []
+        for token in unique_tokens:
+            token_postings = self.get(token)
+            if token_postings is None:
+                return
+            postings.append((len(token_postings), token, token_postings))
+        postings.sort()
+        cursors = [x[2].cursor() for x in postings]
+        slots = dict((x[1], i) for i, x in enumerate(postings))
+        token_slots = [slots[token] for token in tokens]
+        for doc_id in _leapfrog(cursors):
+            field_ids = [cursor.fields() for cursor in cursors]
+            for field_id in field_ids[token_slots[0]]:
+                position_lists = [field_ids[slot].get(field_id) 
+                        for slot in token_slots]
+                if None not in position_lists and \
+                        _in_sequence(position_lists, slop):
+                    yield doc_id
+                    break
+
+    def freeze(self):
+        for postings in self.tokens.itervalues():
+            postings.freeze()
+
+    def thaw(self):
+        """Copy lengths opened from a file into memory for changing."""
+        if not isinstance(self.lengths, array):
+            self.lengths = self.lengths.to_array()
+
+    def _term_counts(self):
+        if self.term_counts is None:
+            counts = {}
+            for terms in self.segment_terms:
+                for token, count in terms.iter_counts():
+                    counts[token] = counts.get(token, 0) + count
+            for token, postings in self.tokens.iteritems():
+                counts[token] = counts.get(token, 0) + len(postings)
+            self.term_counts = TermCounts(counts)
+        return self.term_counts
+
+    def top_terms(self, n=None):
+        """
+        Returns (token, document count) for the n most popular tokens, or 
+        all of them.  Saved segments list their terms by count, so until 
+        documents are added, the n are found from the tops of those lists,
+        and for one segment this costs about n.  Otherwise, or if that 
+        would read more than TOP_TERMS_READS terms per token asked for 
+        from each segment, every token is counted once and the counts kept
+        up as documents are added, so later calls also cost about n.  
+        Deleted documents are counted until the index is optimized.
+
+        >>> index = Index(fields=(Field('title'),), cache=False)
+        >>> index.add(Document(title='Troll bridge'))
+        >>> index.add(Document(title='Troll mountain'))
+        >>> index.save('index')
+        >>> index.fields['title'].top_terms(2)
+        [('troll', 2), ('bridge', 1)]
+        >>> index.add(Document(title='Mountain troll'))
+        >>> index.add(Document(title='Mountain baby'))
+        >>> index.fields['title'].top_terms(3)
+        [('mountain', 3), ('troll', 3), ('baby', 1)]
+        """
+        segment_terms = self.segment_terms
+        if n is not None and self.term_counts is None and not self.tokens \
+                and segment_terms:
+            found = _top_terms(segment_terms, n, 
+                    TOP_TERMS_READS * (n + 1) * len(segment_terms))
+            if found is not None:
+                return found
+        return self._term_counts().top(n)
+
+    def get_token_list(self, n=None):
+        """
+        Get a list of tokens and their postings, sorted by popularity.
+
+        >>> index = Index(fields=(Field('title', 
+        ...         tokenizer=Analyzer(re_string=r'(?u)\w+')),), cache=False)
+        >>> index.add(Document(title=u'Cr\\xe8me br\\xfbl\\xe9e'))
+        >>> index.add(Document(title=u'Cr\\xe8me'))
+        >>> [(x, len(y)) for x, y in index.fields['title'].get_token_list(1)]
+        [('cr\\xc3\\xa8me', 2)]
+        """
+        return [(x[0], self[x[0]]) for x in self.top_terms(n)]
+
+class BM25Scorer(object):
+    """
+    Okapi BM25, computed separately for each weighted field and scaled by 
+    the field's weight.  Document frequencies come from the postings and 
+    length norms from the field lengths kept while indexing, so scoring a
+    hit is a few multiplications.
+    """
+    proximity = False
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+
+    def score(self, index, field_name, weight, frequencies, distances, 
+            match_count=None, statistics=None):
+        """
+        Returns a dictionary of doc IDs to score increments for the 
+        documents in frequencies, a dictionary of doc IDs to the number 
+        of times the query part occurs in field_name.  match_count is the
+        number of documents the part occurs in across the whole field, 
+        when frequencies holds only some of them.  The document count and
+        average length come from statistics, if given, rather than index.
+        """
+        field = index.fields[field_name]
+        if statistics is None:
+            document_count = len(index.documents)
+            average_length = field.average_length() or 1.0
+        else:
+            document_count = statistics.document_count
+            average_length = statistics.average_length(field_name) or 1.0
+        if match_count is None:
+            match_count = len(frequencies)
+        idf = math.log(1 + (document_count - match_count + 0.5) / 
+                (match_count + 0.5))
+        lengths = field.lengths
+        k1 = self.k1
+        scale = weight * idf * (k1 + 1)
+        short = k1 * (1 - self.b)
+        per_length = k1 * self.b / average_length
+        increments = {}
+        for doc_id, frequency in frequencies.iteritems():
+            norm = short + per_length * lengths[doc_id]
+            increments[doc_id] = scale * frequency / (frequency + norm)
+        return increments
+
+    def combine(self, score, increment):
+        return score + increment
+
+class ProximityScorer(object):
+    """
+    The original trwbl scorer.  Each field a word is found in adds its 
+    weight, with a bonus for being close to the previous word in the 
+    query, and scores approach 1 without reaching it.
+    """
+    proximity = True
+
+    def score(self, index, field_name, weight, frequencies, distances, 
+            match_count=None, statistics=None):
+        increments = {}
+        for doc_id in frequencies:
+            weight_mod = [1]
+            for distance in distances.get(doc_id, ()):
+                if distance == 0:
+                    continue
+                elif distance == 1:
+                    distance = distance / 4.0
+                elif 1 < distance < 5:
+                    distance = distance / 2.0
+                elif distance < 0:
+                    distance = -distance
+                weight_mod.append(0.01 / distance)
+            increments[doc_id] = weight * sum(weight_mod)
+        return increments
+
+    def combine(self, score, increment):
+        return score + (1 - score) * increment
+
+class QueryCache(object):
+    """
+    A least recently used cache of ranked search results, keyed on the 
+    parsed query.  Entries belong to the index generation they were made
+    in, and are all dropped once the index changes.  hits and misses count
+    lookups.  It may be shared by threads searching the same index.
+    """
+    def __init__(self, size=100):
+        self.size = size
+        self.generation = None
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, generation):
+        self.lock.acquire()
+        try:
+            if generation != self.generation:
+                self.entries.clear()
+                self.generation = generation
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            # put it back at the most recently used end
+            self.entries[key] = value
+            self.hits += 1
+            return value
+        finally:
+            self.lock.release()
+
+    def set(self, key, generation, value):
+        self.lock.acquire()
+        try:
+            if generation != self.generation:
+                return
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+def _fuzzy_terms(index_field, term, max_edits):
+    """Fuzzy matches for term once it has been through the tokenizer."""
+    tokens = index_field.tokenizer.tokenize(term)
+    if not tokens:
+        return []
+    return index_field.fuzzy_terms(tokens[0], max_edits)
+
+class QueryProfile(object):
+    """
+    Where the time went in one search.  timings holds seconds by stage:
+    parse (and analysis), cache, postings (finding and intersecting them), 
+    match (finding the documents), score, rank and populate.  counters 
+    holds the postings entries touched, candidates scored, tokens 
+    expansions searched for, and documents loaded.
+    """
+    def __init__(self, query):
+        self.query = query
+        self.cached = False
+        self.timings = {}
+        self.counters = {}
+        self.started = self.last = default_timer()
+
+    def mark(self, stage):
+        """Put the time since the last mark down to stage."""
+        now = default_timer()
+        self.timings[stage] = self.timings.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def count(self, name, number=1):
+        self.counters[name] = self.counters.get(name, 0) + number
+
+    def elapsed(self):
+        return self.last - self.started
+
+    def as_dict(self):
+        return {
+            'query': self.query,
+            'cached': self.cached,
+            'seconds': self.elapsed(),
+            'timings': self.timings,
+            'counters': self.counters,
+        }
+
+class Profiler(object):
+    """
+    Instrumentation for an index, off unless set as index.profiler.  Each
+    search then gets a QueryProfile, found as results.profile, which is 
+    added to the running timings and counters here and passed to sink, 
+    if given.  The index also counts documents added and deleted, and 
+    saves.  Without a profiler, searches only check for one at each stage.
+
+    >>> profiler = Profiler()
+    >>> index = Index(fields=(Field('title'),), cache=False)
+    >>> index.profiler = profiler
+    >>> index.add(Document(title='The Troll Mountain'))
+    >>> results = index.search('troll')
+    >>> sorted(results.profile.counters.items())
+    [('candidates', 1), ('documents', 1), ('postings', 1)]
+    >>> profiler.counters['searches'], profiler.counters['added']
+    (1, 1)
+    """
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.timings = {}
+        self.counters = {}
+
+    def count(self, name, number=1):
+        self.counters[name] = self.counters.get(name, 0) + number
+
+    def start(self, query):
+        return QueryProfile(query)
+
+    def finish(self, profile):
+        self.count('searches')
+        if profile.cached:
+            self.count('cache_hits')
+        for name, number in profile.counters.iteritems():
+            self.count(name, number)
+        for stage, seconds in profile.timings.iteritems():
+            self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+        if self.sink is not None:
+            self.sink(profile)
+
+class LoggingSink(object):
+    """
+    A Profiler sink logging each search slower than slower_than seconds,
+    with its timings and counters.
+    """
+    def __init__(self, logger=None, level=logging.INFO, slower_than=0.0):
+        self.logger = logger or logging.getLogger('trwbl')
+        self.level = level
+        self.slower_than = slower_than
+
+    def __call__(self, profile):
+        if profile.elapsed() >= self.slower_than:
+            self.logger.log(self.level, "search %r took %.2f ms: %s %s", 
+                    profile.query, profile.elapsed() * 1000, 
+                    ' '.join('%s=%.2fms' % (x, y * 1000) for x, y in 
+                    sorted(profile.timings.iteritems())), 
+                    ' '.join('%s=%d' % x for x in 
+                    sorted(profile.counters.iteritems())))
+
+class Statistics(object):
+    """
+    What BM25 scores a query with besides the postings: the number of 
+    documents, the total length and number of documents of each field, 
+    and the number of documents each query part matches in each field, 
+    by (part number, field name).  Adding up the statistics of the shards
+    of a ShardedIndex lets every shard score as if it were the whole.
+    """
+    def __init__(self, document_count=0, field_lengths=None, 
+            match_counts=None):
+        self.document_count = document_count
+        self.field_lengths = field_lengths or {}
+        self.match_counts = match_counts or {}
+
+    def average_length(self, field_name):
+        total_length, document_count = self.field_lengths.get(field_name, 
+                (0, 0))
+        if not document_count:
+            return 0.0
+        return total_length / float(document_count)
+
+    def __add__(self, other):
+        field_lengths = dict(self.field_lengths)
+        for name, (total_length, document_count) in \
+                other.field_lengths.iteritems():
+            lengths = field_lengths.get(name, (0, 0))
+            field_lengths[name] = (lengths[0] + total_length, 
+                    lengths[1] + document_count)
+        match_counts = dict(self.match_counts)
+        for key, count in other.match_counts.iteritems():
+            match_counts[key] = match_counts.get(key, 0) + count
+        return Statistics(self.document_count + other.document_count, 
+                field_lengths, match_counts)
+
+    def key(self):
+        """A hashable summary, for caching results scored with these."""
+        return (self.document_count, tuple(sorted(
+                self.field_lengths.iteritems())), tuple(sorted(
+                self.match_counts.iteritems())))
 
 class ResultSet(object):
-    def __init__(self, index, query):
-        # document_scores is a list of (score, document_id) tuples
-        self.document_scores = [(0, x) for x in index.documents]
-        # part_locations are the locations of the most recent query part
-        self.previous_locations = {}
+    """
+    The documents matching a query.  documents holds only the page asked 
+    for by limit and offset, best first; total is the number of matches.
+
+    A query is evaluated as the boolean clauses of a BooleanQuery in two 
+    passes.  The first finds the matching documents as a Bitmap of 
+    candidates: MUST clauses, then groups of SHOULD clauses, intersect 
+    it, each looking up only the candidates left where it can, and 
+    MUST_NOT clauses are taken out of it.  Field and range clauses are 
+    only filters, matched as whole sets of documents.  The second pass 
+    scores just the candidates that remain, from the frequencies found
+    on the way.  Only a query with no positive clauses at all has to walk
+    every document.
+    """
+    def __init__(self, index, query, limit=None, offset=0, statistics=None, 
+            fields=None):
+        # scores maps matching doc_ids to scores, once evaluated
+        self.scores = None
+        # documents matched by each query part in each field, and the
+        # Statistics to score with instead of the index's own, if any
+        self.match_counts = {}
+        self.statistics = statistics
+        # a QueryProfile, when the index has a profiler
+        self.profile = None
         self.index = index
-        self.search(query)
+        self.limit = limit
+        self.offset = offset
+        # the stored fields to load, or None for all of them
+        self.fields = fields
+        if query is not None:
+            self.search(query)
+
+    def search(self, query):
+        profiler = self.index.profiler
+        if profiler is None:
+            return self.populate(*self.ranking(query))
+        profile = self.profile = profiler.start(query)
+        self.populate(*self.ranking(query))
+        profile.mark('populate')
+        profile.count('documents', len(self.documents))
+        profiler.finish(profile)
+        return self
+
+    def ranking(self, query):
+        """
+        Returns the number of matches for query and a list of (score, 
+        doc_id) for the best offset + limit of them, from query_cache if
+        the index is unchanged.
+        """
+        profile = self.profile
+        parsed = self.index.parse(query)
+        if profile is not None:
+            profile.mark('parse')
+        # the page is cut from the best offset + limit matches
+        depth = None if self.limit is None else self.offset + self.limit
+        key = (parsed.key, depth)
+        if self.statistics is not None:
+            key += (self.statistics.key(),)
+        cache = self.index.query_cache
+        ranked = cache.get(key, self.index.generation)
+        if ranked is None:
+            self.evaluate(parsed)
+            ranked = self.rank(depth)
+            cache.set(key, self.index.generation, ranked)
+            if profile is not None:
+                profile.mark('rank')
+        elif profile is not None:
+            profile.cached = True
+            profile.mark('cache')
+        return ranked
+
+    def evaluate(self, parsed):
+        """Find and score the matches for an analyzed BooleanQuery."""
+        clauses = []
+        groups = []
+        for group in parsed.groups:
+            groups.append(range(len(clauses), len(clauses) + len(group)))
+            clauses.extend(group)
+        matches = [None] * len(clauses)
+        candidates = None
+        def match(number):
+            matches[number] = self._match(clauses[number], candidates)
+            return matches[number][0]
+        for number, clause in enumerate(clauses):
+            if clause[0] == MUST:
+                candidates = match(number)
+        for group in groups:
+            if all(clauses[x][0] == SHOULD for x in group):
+                found = Bitmap()
+                for number in group:
+                    found = found | match(number)
+                candidates = found
+        excluded = Bitmap()
+        for number, clause in enumerate(clauses):
+            if clause[0] == MUST_NOT:
+                excluded = excluded | match(number)
+        if candidates is None:
+            candidates = Bitmap()
+            candidates.update(self.index.documents)
+        candidates = candidates - excluded - self.index.deleted
+        # SHOULD clauses beside a MUST clause only add to scores
+        for number in xrange(len(clauses)):
+            if matches[number] is None:
+                match(number)
+        self._score_matches(candidates, clauses, matches)
+
+    def _score_matches(self, candidates, clauses, matches):
+        scorer = self.index.scorer
+        self.scores = scores = dict.fromkeys(candidates, 0)
+        previous_locations = {}
+        for clause, (found, scoring) in zip(clauses, matches):
+            word_locations = {}
+            if clause[0] == MUST_NOT or scoring is None:
+                previous_locations = word_locations
+                continue
+            for field_name, weight, frequencies, locations, match_count in \
+                    scoring:
+                if locations is not None:
+                    word_locations[field_name] = locations
+                frequencies = dict(x for x in frequencies.iteritems() 
+                        if x[0] in scores)
+                if not frequencies:
+                    continue
+                # distances from this word to the previous one, by document
+                distances = {}
+                previous = previous_locations.get(field_name)
+                if scorer.proximity and previous and locations is not None:
+                    for doc_id, field_id, token_ids, previous_token_ids in \
+                            locations._field_pairs(previous):
+                        if doc_id in frequencies:
+                            distances.setdefault(doc_id, []).extend(
+                                    _nearest(token_ids, previous_token_ids))
+                increments = self._score_part(field_name, weight, 
+                        frequencies, distances, match_count)
+                for doc_id, increment in increments.iteritems():
+                    scores[doc_id] = scorer.combine(scores[doc_id], increment)
+            previous_locations = word_locations
+
+    def rank(self, depth=None):
+        """
+        Return the number of matches and a list of (score, doc_id) for the
+        best depth of them, or all of them when depth is None.
+        """
+        if self.scores is None:
+            self.scores = dict.fromkeys(self.index.documents, 0)
+        document_scores = ((x[1], x[0]) for x in self.scores.iteritems())
+        if depth is None:
+            ranking = sorted(document_scores, reverse=True)
+        else:
+            # a bounded heap keeps this O(n log k) rather than a full sort
+            ranking = heapq.nlargest(depth, document_scores)
+        return len(self.scores), ranking
+
+    def populate(self, total, ranking):
+        """Load the documents of the page asked for from the ranking."""
+        self.documents = []
+        self.total = total
+        for score, document_id in ranking[self.offset:]:
+            document = self.index.documents.get(document_id, 
+                    fields=self.fields)
+            document.score = score
+            self.documents.append(document)
+        return self
+
+    def _match(self, clause, candidates):
+        """
+        Returns a Bitmap of the documents matching a clause, only among 
+        candidates unless that is None, and for scored clauses a list of 
+        (field_name, weight, frequencies, locations, match_count) for each
+        weighted field it is found in, or None for filters.
+        """
+        occur, part_number, query = clause
+        if isinstance(query, (FieldQuery, RangeQuery)):
+            documents = self._filter_documents(query)
+            if candidates is not None:
+                documents = documents & candidates
+            if self.profile is not None:
+                self.profile.mark('match')
+            return documents, None
+        candidate_ids = None if candidates is None else list(candidates)
+        if isinstance(query, PhraseQuery):
+            scoring = self._phrase_matches(part_number, candidates, query)
+        elif query.pattern:
+            scoring = self._expanded_matches(part_number, candidate_ids, 
+                    lambda x: x.match_terms(query.word, MAX_EXPANSIONS))
+        elif query.fuzzy:
+            term, max_edits = query.fuzzy
+            scoring = self._expanded_matches(part_number, candidate_ids, 
+                    lambda x: [token for distance, token in 
+                    _fuzzy_terms(x, term, max_edits)[:MAX_EXPANSIONS]])
+        else:
+            scoring = self._word_matches(part_number, candidate_ids, query)
+        found = Bitmap()
+        for field_scoring in scoring:
+            found.update(field_scoring[2])
+        return found, scoring
+
+    def _filter_documents(self, query):
+        """
+        The Bitmap of documents matching a FieldQuery or RangeQuery, from 
+        the index's filter_cache while the index is unchanged.
+        """
+        cache = self.index.filter_cache
+        documents = cache.get(query.key, self.index.generation)
+        if documents is None:
+            documents = Bitmap()
+            if isinstance(query, FieldQuery):
+                documents.update(self._field_documents(query))
+            else:
+                index_field = self.index.fields[query.field]
+                documents.update(index_field.terms_documents(
+                        index_field.range_terms(*query.bounds)))
+            cache.set(query.key, self.index.generation, documents)
+        return documents
+
+    def _field_documents(self, query):
+        """
+        The documents with the value of a FieldQuery in its field.  Only 
+        that field's postings are read.
+        """
+        index_field = self.index.fields[query.field]
+        value = query.value
+        if isinstance(value, TermQuery) and value.pattern:
+            return index_field.terms_documents(
+                    index_field.match_terms(value.word))
+        elif isinstance(value, TermQuery) and value.fuzzy:
+            return index_field.terms_documents(x[1] for x in 
+                    _fuzzy_terms(index_field, *value.fuzzy))
+        tokens = value.tokens[query.field]
+        if tokens:
+            return index_field.phrase_documents(tokens)
+        return ()
+
+    def _match_count(self, part_number, field_name, match_count):
+        """
+        Note the number of documents a query part matches in a field, and
+        return the number to score with.
+        """
+        key = (part_number, field_name)
+        self.match_counts[key] = match_count
+        if self.statistics is not None:
+            return self.statistics.match_counts.get(key, match_count)
+        return match_count
+
+    def _score_part(self, field_name, weight, frequencies, distances, 
+            match_count):
+        scorer = self.index.scorer
+        profile = self.profile
+        if profile is not None:
+            profile.mark('match')
+            profile.count('candidates', len(frequencies))
+        if self.statistics is None:
+            increments = scorer.score(self.index, field_name, weight, 
+                    frequencies, distances, match_count)
+        else:
+            increments = scorer.score(self.index, field_name, weight, 
+                    frequencies, distances, match_count, self.statistics)
+        if profile is not None:
+            profile.mark('score')
+        return increments
+
+    def _expanded_matches(self, part_number, candidate_ids, expand):
+        """
+        Match as if for any of the tokens expand(field) gives for each 
+        weighted field.  A document's frequency is the sum over the tokens
+        it holds.
+        """
+        scoring = []
+        for weight, field_name in self.index.weighted_fields:
+            index_field = self.index.fields[field_name]
+            frequencies = {}
+            match_count = 0
+            for token in expand(index_field):
+                postings = index_field[token]
+                match_count += len(postings)
+                if self.profile is not None:
+                    self.profile.count('postings', len(postings))
+                    self.profile.count('expansions')
+                for doc_id, frequency in postings.frequencies(candidate_ids):
+                    frequencies[doc_id] = \
+                            frequencies.get(doc_id, 0) + frequency
+            if self.profile is not None:
+                self.profile.mark('match')
+            if not match_count:
+                continue
+            # documents holding several of the tokens are counted for each
+            match_count = self._match_count(part_number, field_name, 
+                    min(match_count, index_field.document_count))
+            if frequencies:
+                scoring.append((field_name, weight, frequencies, None, 
+                        match_count))
+        return scoring
 
-    def search(self, query):
-        query_parts = parse_query(query)
-        for part in query_parts:
-            phrase, field_op, field, field_query, word_op, word = part
-            if phrase:
-                self._phrase_search(phrase)
-            if field_query:
-                if field_query.startswith('('):
-                    field_query = field_query.strip('()')
-                field_query_parts = field_query_parse(field_query)
-                for fq_part in field_query_parts:
-                    self._field_search(fq_part, field, field_op)
-            if word:
-                self._word_search(word, word_op)
-        return self.populate()
-
-    def populate(self):
-        self.documents = []
-        self.document_scores.sort()
-        self.document_scores.reverse()
-        for score, document_id in self.document_scores:
-            document = self.index.documents[document_id]
-            document.score = score
-            self.documents.append(document)
-        return self
+    def _phrase_matches(self, part_number, candidates, query):
+        scoring = []
+        for weight, field_name in self.index.weighted_fields:
+            index_field = self.index.fields[field_name]
+            tokens = query.tokens[field_name]
+            if not tokens:
+                continue
+            # phrase matching stops at the first match in each document
+            frequencies = dict.fromkeys(
+                    index_field.phrase_documents(tokens, query.slop), 1)
+            if self.profile is not None:
+                self.profile.mark('match')
+            if not frequencies:
+                continue
+            match_count = self._match_count(part_number, field_name, 
+                    len(frequencies))
+            if candidates is not None:
+                frequencies = dict((x, 1) for x in frequencies 
+                        if x in candidates)
+            if frequencies:
+                scoring.append((field_name, weight, frequencies, None, 
+                        match_count))
+        return scoring
 
-    def _field_search(self, field_query, field, field_op=None):
-        pass
-
-    def _phrase_search(self, phrase):
-        pass
-
-    def _word_search(self, word, word_op=None):
-        negative = False
-        if word_op:
-            if word_op == '-':
-                negative = True
-            elif word_op == '+':
-                pass  # could extend at some point
-        word_locations = {}
-        found_docs = []
+    def _word_matches(self, part_number, candidate_ids, query):
+        scoring = []
+        profile = self.profile
         for weight, field_name in self.index.weighted_fields:
-            #print field_name
             index_field = self.index.fields[field_name]
-            tokens = index_field.tokenizer.tokenize(word)
-            #print tokens
-            document_ids = []
             locations = None
-            previous_locations = None
             # for each token, only keep locations that are a distance of 1 from
             # a previous location
-            for enum, token in enumerate(tokens):
-                if token in index_field:
-                    locations = index_field[token]
+            for token in query.tokens[field_name]:
+                postings = index_field.get(token)
+                if postings is None:
+                    locations = None
+                    break
+                if profile is not None:
+                    profile.count('postings', len(postings))
+                if locations is None:
+                    locations = postings
                 else:
-                    continue
-                if previous_locations:
-                    locations = locations.get_consecutive(previous_locations)
-                previous_locations = locations
-            word_locations = locations
-            if negative:
-                self.document_scores = [x for x in self.document_scores if 
-                        x[1] not in locations]
-            else:
-                distances = self._get_distances(
-                        self.previous_locations[field_name], document_ids)
-                for enum, score_id in enumerate(self.document_scores):
-                    score, id = score_id
-                    if id in document_ids:
-                        found_docs.append(id)
-                        document = document_ids[id]
-                        #print "{%s: %s}" % (id, document)
-                        if field_name in locations:
-                            locations[field_name][id] = document
-                        else:
-                            locations[field_name] = {id: document}
-                        distances = self._get_distances(
-                            self.previous_locations[field_name], 
-                            {id: document})
-                        weight_mod = [1]
-                        for distance in distances:
-                            if distance == 1:
-                                distance = distance / 4.0
-                            elif 1 < distance < 5:
-                                distance = distance / 2.0
-                            elif distance < 0:
-                                distance = -distance
-                            weight_mod.append(0.01 / distance)
-                        modified_weight = weight * sum(weight_mod)
-                        score += (1 - score) * modified_weight
-                        self.document_scores[enum] = (score, id)
-        if not negative:
-            self.document_scores = [x for x in self.document_scores if 
-                    x[1] in set(found_docs)]
-        self.previous_locations = locations
+                    locations = postings.get_consecutive(locations)
+            if profile is not None:
+                profile.mark('postings')
+            if not locations:
+                continue
+            match_count = self._match_count(part_number, field_name, 
+                    len(locations))
+            # only the candidates are looked up, by seeking in the postings
+            frequencies = dict(locations.frequencies(candidate_ids))
+            if profile is not None:
+                profile.mark('match')
+            if frequencies:
+                scoring.append((field_name, weight, frequencies, locations, 
+                        match_count))
+        return scoring
 
 class IndexFieldDict(dict):
     def __getitem__(self, field_name):
@@ -363,13 +2415,707 @@ class IndexFieldDict(dict):
         else:
             dict.__setitem__(self, field_name, field)
     
+INDEX_MAGIC = 'TRWBL\x00\x08\n'
+TRAILER_POINTER = struct.Struct('<Q')
+# term offset, term length, postings offset, postings length, doc count,
+# last doc ID, skip pointer count
+TERM_RECORD = struct.Struct('<QIQIIII')
+# trigram offset, trigram length, token numbers offset, token count
+GRAM_RECORD = struct.Struct('<QIQI')
+# doc ID, compressed block offset, block length, and where the stored 
+# fields start and end in the decompressed block
+DOC_RECORD = struct.Struct('<IQIII')
+UINT = struct.Struct('<I')
+# stored documents are compressed together in blocks of about this size
+DOC_BLOCK_SIZE = 16384
+# decompressed blocks kept by each segment
+DOC_BLOCK_CACHE = 8
+
+def _encode_fields(fields):
+    """
+    Encode stored fields as a varint-prefixed name and pickled value for
+    each, so some can be decoded without unpickling the rest.
+    """
+    buf = bytearray()
+    for name, value in fields.iteritems():
+        value = pickle.dumps(value, -1)
+        _put_varint(buf, len(name))
+        buf.extend(name)
+        _put_varint(buf, len(value))
+        buf.extend(value)
+    return buf
+
+def _decode_fields(buf, pos, end, names=None):
+    """Decode the stored fields in names, or all of them."""
+    fields = {}
+    while pos < end:
+        length, pos = _get_varint(buf, pos)
+        name = str(buf[pos:pos + length])
+        pos += length
+        length, pos = _get_varint(buf, pos)
+        if names is None or name in names:
+            fields[name] = pickle.loads(str(buf[pos:pos + length]))
+        pos += length
+    return fields
+
+def _term_bytes(term):
+    if isinstance(term, unicode):
+        return term.encode('utf-8')
+    return term
+
+class SegmentTerms(object):
+    """
+    The read-only term dictionary of one field in a segment.  Terms are 
+    sorted, with fixed-size records, so a lookup is a binary search over
+    the mapped file and only the matching postings are copied out.  The 
+    terms' numbers are also listed by document count, most first.
+    """
+    def __init__(self, buf, offset, count, by_count):
+        self.buf = buf
+        self.offset = offset
+        self.count = count
+        self.by_count = SegmentArray(buf, by_count, count)
+
+    def _record(self, i):
+        return TERM_RECORD.unpack_from(self.buf, 
+                self.offset + i * TERM_RECORD.size)
+
+    def _term(self, record):
+        return self.buf[record[0]:record[0] + record[1]]
+
+    def _postings(self, record):
+        offset, length, skip_count = record[2], record[3], record[6]
+        end = offset + length
+        if skip_count:
+            # skip doc IDs and offsets follow the postings data
+            skips_end = end + 8 * skip_count
+            return Postings.from_data(self.buf[offset:end], record[4], 
+                    record[5], _array_from_bytes(self.buf[end:end + 
+                    4 * skip_count]), _array_from_bytes(self.buf[end + 
+                    4 * skip_count:skips_end]))
+        return Postings.from_data(self.buf[offset:end], record[4], record[5])
+
+    def _find(self, term):
+        key = _term_bytes(term)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            record = self._record(middle)
+            middle_term = self._term(record)
+            if middle_term < key:
+                low = middle + 1
+            elif middle_term > key:
+                high = middle
+            else:
+                return record
+        return None
+
+    def get(self, term, default=None):
+        record = self._find(term)
+        if record is None:
+            return default
+        return self._postings(record)
+
+    def __getitem__(self, term):
+        record = self._find(term)
+        if record is None:
+            raise KeyError(term)
+        return self._postings(record)
+
+    def __contains__(self, term):
+        return self._find(term) is not None
+
+    def __len__(self):
+        return self.count
+
+    def _lower_bound(self, key):
+        """The index of the first term not less than key."""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._term(self._record(middle)) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def __iter__(self):
+        return self.iter_range('')
+
+    def iter_range(self, start, stop=None):
+        """Yields the terms from start up to, but not including, stop."""
+        for i in xrange(self._lower_bound(start), self.count):
+            term = self._term(self._record(i))
+            if stop is not None and term >= stop:
+                break
+            yield term
+
+    def iteritems(self):
+        for i in xrange(self.count):
+            record = self._record(i)
+            yield self._term(record), self._postings(record)
+
+    def doc_count(self, term):
+        """The number of documents holding term, without its postings."""
+        record = self._find(term)
+        if record is None:
+            return 0
+        return record[4]
+
+    def iter_counts(self):
+        """Yields (term, document count) without reading the postings."""
+        for i in xrange(self.count):
+            record = self._record(i)
+            yield self._term(record), record[4]
+
+    def iter_top(self):
+        """Yields (term, document count) by count and then term."""
+        for i in self.by_count:
+            record = self._record(i)
+            yield self._term(record), record[4]
+
+    def itervalues(self):
+        for term, postings in self.iteritems():
+            yield postings
+
+class SegmentArray(object):
+    """A read-only array('I') in a segment, read an item at a time."""
+    def __init__(self, buf, offset, count):
+        self.buf = buf
+        self.offset = offset
+        self.count = count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return UINT.unpack_from(self.buf, self.offset + i * UINT.size)[0]
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in xrange(self.count):
+            yield self[i]
+
+    def to_array(self):
+        return _array_from_bytes(self.buf[self.offset:self.offset + 
+                self.count * UINT.size])
+
+class SegmentNGrams(object):
+    """
+    The read-only trigrams of the terms of one field in a segment, as an 
+    NGramIndex would have them with each term numbered by its place in 
+    the term dictionary.  Trigrams are sorted, with fixed-size records, 
+    and found by binary search.
+    """
+    ordered = True
+
+    def __init__(self, buf, terms, grams, short_tokens, lengths):
+        self.buf = buf
+        self.terms = terms
+        self.offset, self.count = grams
+        self.short_tokens = short_tokens
+        self.lengths = SegmentArray(buf, *lengths)
+
+    def _record(self, i):
+        return GRAM_RECORD.unpack_from(self.buf, 
+                self.offset + i * GRAM_RECORD.size)
+
+    def _token_ids(self, offset, count):
+        return _array_from_bytes(self.buf[offset:offset + count * UINT.size])
+
+    def gram_tokens(self, gram):
+        key = gram.encode('utf-8')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            record = self._record(middle)
+            middle_gram = self.buf[record[0]:record[0] + record[1]]
+            if middle_gram < key:
+                low = middle + 1
+            elif middle_gram > key:
+                high = middle
+            else:
+                return self._token_ids(record[2], record[3])
+        return ()
+
+    def short(self, length):
+        if length in self.short_tokens:
+            return self._token_ids(*self.short_tokens[length])
+        return ()
+
+    def token(self, token_id):
+        return self.terms._term(self.terms._record(token_id))
+
+    def char_lengths(self):
+        # read whole at the first fuzzy search, as it is looked up often
+        if not isinstance(self.lengths, array):
+            self.lengths = self.lengths.to_array()
+        return self.lengths
+
+class SegmentDocuments(object):
+    """
+    The read-only stored documents of a segment.  They are zlib 
+    compressed in blocks of neighbouring documents, found through a table
+    of records sorted by doc ID, and only decoded when asked for.  Only 
+    the fields asked for are unpickled.
+    """
+    def __init__(self, buf, offset, count):
+        self.buf = buf
+        self.offset = offset
+        self.count = count
+        # decompressed blocks by offset
+        self.blocks = {}
+
+    def _record(self, i):
+        return DOC_RECORD.unpack_from(self.buf, 
+                self.offset + i * DOC_RECORD.size)
+
+    def _find(self, doc_id):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            record = self._record(middle)
+            if record[0] < doc_id:
+                low = middle + 1
+            elif record[0] > doc_id:
+                high = middle
+            else:
+                return record
+        return None
+
+    def _block(self, offset, length):
+        block = self.blocks.get(offset)
+        if block is None:
+            block = bytearray(zlib.decompress(self.buf[offset:offset + length]))
+            if len(self.blocks) >= DOC_BLOCK_CACHE:
+                self.blocks.clear()
+            self.blocks[offset] = block
+        return block
+
+    def _document(self, record, fields=None):
+        doc_id, offset, length, start, end = record
+        document = Document(**_decode_fields(self._block(offset, length), 
+                start, end, fields))
+        document.id = doc_id
+        return document
+
+    def get(self, doc_id, default=None, fields=None):
+        """
+        Returns the document with doc_id, holding only the stored fields
+        named in fields if given.
+        """
+        record = self._find(doc_id)
+        if record is None:
+            return default
+        return self._document(record, fields)
+
+    def __getitem__(self, doc_id):
+        record = self._find(doc_id)
+        if record is None:
+            raise KeyError(doc_id)
+        return self._document(record)
+
+    def __contains__(self, doc_id):
+        return self._find(doc_id) is not None
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in xrange(self.count):
+            yield self._record(i)[0]
+
+    def iteritems(self):
+        for i in xrange(self.count):
+            record = self._record(i)
+            yield record[0], self._document(record)
+
+def _write_table(handle, record_struct, records):
+    offset = handle.tell()
+    for record in records:
+        handle.write(record_struct.pack(*record))
+    return offset, len(records)
+
+def _write_ngrams(handle, ngrams):
+    """
+    Write the tables of an NGramIndex of a segment's sorted terms, whose 
+    token numbers are then the terms' own.  Returns their locations.
+    """
+    gram_records = []
+    for gram, token_ids in sorted((x.encode('utf-8'), y) 
+            for x, y in ngrams.grams.iteritems()):
+        gram_records.append((handle.tell(), len(gram)))
+        handle.write(gram)
+        gram_records[-1] += (handle.tell(), len(token_ids))
+        handle.write(_array_to_bytes(token_ids))
+    short_tokens = {}
+    for length, token_ids in ngrams.short_tokens.iteritems():
+        short_tokens[length] = (handle.tell(), len(token_ids))
+        handle.write(_array_to_bytes(token_ids))
+    lengths = (handle.tell(), len(ngrams.lengths))
+    handle.write(_array_to_bytes(ngrams.lengths))
+    return _write_table(handle, GRAM_RECORD, gram_records), short_tokens, \
+            lengths
+
+def _write_segment(handle, documents, field_terms):
+    """
+    Write stored documents, then the postings, terms by count, term 
+    dictionary, and term trigrams of each field, to handle.  field_terms 
+    maps field names to sorted lists of (term bytes, Postings).  Returns 
+    the segment's table locations.
+    """
+    segment = {'fields': {}, 'ngrams': {}}
+    doc_records = []
+    block = bytearray()
+    block_doc_records = []
+    def write_block():
+        compressed = zlib.compress(str(block))
+        offset = handle.tell()
+        handle.write(compressed)
+        for doc_id, start, end in block_doc_records:
+            doc_records.append((doc_id, offset, len(compressed), start, end))
+        del block[:], block_doc_records[:]
+    for doc_id in sorted(documents):
+        start = len(block)
+        block.extend(_encode_fields(documents[doc_id].fields))
+        block_doc_records.append((doc_id, start, len(block)))
+        if len(block) >= DOC_BLOCK_SIZE:
+            write_block()
+    if block_doc_records:
+        write_block()
+    segment['documents'] = _write_table(handle, DOC_RECORD, doc_records)
+    if doc_records:
+        segment['doc_ids'] = (doc_records[0][0], doc_records[-1][0])
+    else:
+        segment['doc_ids'] = (0, -1)
+    for field_name, terms in field_terms.iteritems():
+        # postings are written as they come; only the terms are kept
+        term_list = []
+        postings_records = []
+        for term, postings in terms:
+            term_list.append(term)
+            postings.freeze()
+            skip_count = 0
+            postings_records.append((handle.tell(), len(postings.data), 
+                    postings.doc_count, postings.last_doc_id))
+            handle.write(postings.data)
+            if postings.skip_doc_ids:
+                skip_count = len(postings.skip_doc_ids)
+                handle.write(_array_to_bytes(postings.skip_doc_ids))
+                handle.write(_array_to_bytes(postings.skip_offsets))
+            postings_records[-1] += (skip_count,)
+        term_records = []
+        for term, postings_record in zip(term_list, postings_records):
+            term_records.append((handle.tell(), len(term)) + postings_record)
+            handle.write(term)
+        # term numbers by document count; the sort keeps term order in ties
+        by_count = array('I', sorted(xrange(len(term_records)), 
+                key=lambda i: -term_records[i][4]))
+        by_count_offset = handle.tell()
+        handle.write(_array_to_bytes(by_count))
+        segment['fields'][field_name] = _write_table(handle, TERM_RECORD, 
+                term_records) + (by_count_offset,)
+        segment['ngrams'][field_name] = _write_ngrams(handle, 
+                NGramIndex(term_list))
+    return segment
+
+class Segment(object):
+    """
+    A batch of documents saved together, with their postings for each 
+    field.  Segments are never changed once written; deleting a document 
+    marks it in the index's deleted bitmap instead.
+    """
+    def __init__(self, buf, meta):
+        self.meta = meta
+        self.first_doc_id, self.last_doc_id = meta['doc_ids']
+        self.documents = SegmentDocuments(buf, *meta['documents'])
+        self.terms = {}
+        self.ngrams = {}
+        for field_name, table in meta['fields'].iteritems():
+            self.terms[field_name] = SegmentTerms(buf, *table)
+            self.ngrams[field_name] = SegmentNGrams(buf, 
+                    self.terms[field_name], *meta['ngrams'][field_name])
+
+class IndexDocuments(object):
+    """
+    The live documents of an index: those in its saved segments and those
+    added since, less any deleted.
+    """
+    def __init__(self, index):
+        self.index = index
+
+    def get(self, doc_id, default=None, fields=None):
+        """
+        Returns the document with doc_id, holding only the stored fields 
+        named in fields if given.
+        """
+        index = self.index
+        if doc_id in index.deleted:
+            return default
+        if doc_id in index.new_documents:
+            document = index.new_documents[doc_id]
+            if fields is None:
+                return document
+            selected = Document(**dict((x, document.fields[x]) 
+                    for x in fields if x in document.fields))
+            selected.id = doc_id
+            return selected
+        for segment in index.segments:
+            if segment.first_doc_id <= doc_id <= segment.last_doc_id:
+                return segment.documents.get(doc_id, default, fields)
+        return default
+
+    def __getitem__(self, doc_id):
+        document = self.get(doc_id)
+        if document is None:
+            raise KeyError(doc_id)
+        return document
+
+    def __contains__(self, doc_id):
+        index = self.index
+        if doc_id in index.deleted:
+            return False
+        if doc_id in index.new_documents:
+            return True
+        for segment in index.segments:
+            if segment.first_doc_id <= doc_id <= segment.last_doc_id:
+                return doc_id in segment.documents
+        return False
+
+    def __len__(self):
+        index = self.index
+        return (sum(len(x.documents) for x in index.segments) + 
+                len(index.new_documents) - len(index.deleted))
+
+    def __iter__(self):
+        deleted = self.index.deleted
+        for segment in self.index.segments:
+            for doc_id in segment.documents:
+                if doc_id not in deleted:
+                    yield doc_id
+        for doc_id in sorted(self.index.new_documents):
+            if doc_id not in deleted:
+                yield doc_id
+
+    def iteritems(self):
+        for doc_id in self:
+            yield doc_id, self[doc_id]
+
+def _checksum(value):
+    return zlib.crc32(value) & 0xffffffff
+
+class CacheBackend(object):
+    """
+    Somewhere to keep whole index files by filename, so that processes 
+    opening an index need not read it from disk.  A file is split into 
+    chunks of at most chunk_size bytes, stored under keys carrying its 
+    checksum, and a header under the filename says which chunks make it
+    up.  The old header is cleared first and the new one written last, so
+    readers only find complete files, a set that fails leaves a miss 
+    rather than the previous file, and a missing or damaged chunk reads 
+    as a miss.
+
+    Subclasses store the values with get_many and set_many.
+
+    >>> cache = MemcacheBackend(client=LocalMemcacheClient(32))
+    >>> cache.chunk_size = 8
+    >>> cache.set('idx', 'old index file contents')
+    >>> cache.get('idx'), len(cache.client.values)
+    ('old index file contents', 4)
+    >>> cache.client.values[sorted(cache.client.values)[1]] = 'damaged!'
+    >>> print cache.get('idx')
+    None
+    >>> cache.set('idx', 'old index file contents')
+    >>> cache.chunk_size = 64
+    >>> cache.set('idx', 'a new index file, in a chunk too big to store')
+    >>> print cache.get('idx')
+    None
+    """
+    chunk_size = 1024 * 1024 - 4096  # under memcached's 1 MB item limit
+
+    def get_many(self, keys):
+        """Return a dictionary of the keys found and their values."""
+        raise NotImplementedError
+
+    def set_many(self, values):
+        """Store a dictionary of values, returning True if all were."""
+        raise NotImplementedError
+
+    def _chunk_key(self, key, checksum, number):
+        return '%s.%08x.%d' % (key, checksum, number)
+
+    def get(self, key):
+        header = self.get_many([key]).get(key)
+        try:
+            size, checksum, count = [int(x) for x in header.split()]
+        except (AttributeError, ValueError):
+            return None
+        keys = [self._chunk_key(key, checksum, x) for x in xrange(count)]
+        chunks = self.get_many(keys)
+        try:
+            value = ''.join([chunks[x] for x in keys])
+        except KeyError:
+            return None
+        if len(value) != size or _checksum(value) != checksum:
+            return None
+        return value
+
+    def set(self, key, value):
+        self.set_file(key, StringIO(value))
+
+    def set_file(self, key, handle):
+        """
+        Store the rest of an open file under key.  It is read twice, a 
+        chunk at a time, first for its checksum and then to store it, so 
+        it never sits in memory whole.
+        """
+        start = handle.tell()
+        size = checksum = 0
+        for chunk in iter(lambda: handle.read(self.chunk_size), ''):
+            size += len(chunk)
+            checksum = zlib.crc32(chunk, checksum)
+        checksum &= 0xffffffff
+        handle.seek(start)
+        self.set_many({key: ''})
+        count = 0
+        for chunk in iter(lambda: handle.read(self.chunk_size), ''):
+            if not self.set_many({self._chunk_key(key, checksum, count): 
+                    chunk}):
+                return
+            count += 1
+        self.set_many({key: '%d %d %d' % (size, checksum, count)})
+
+class DictBackend(CacheBackend):
+    """
+    Keeps index files in a dictionary in this process, whole, since there
+    is no item limit to chunk them for.
+    """
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def set_file(self, key, handle):
+        self.values[key] = handle.read()
+
+# memcache clients by server list, shared by every index in the process
+_memcache_clients = {}
+
+class MemcacheBackend(CacheBackend):
+    """
+    Keeps index files in memcached.  One client is made per server list 
+    and reused by every index, rather than one per open and save; 
+    python-memcached keeps a connection per thread, open between calls.
+    client may be anything with the memcache.Client interface, such as 
+    LocalMemcacheClient.
+    """
+    def __init__(self, servers=(MEMCACHE_LOCATION,), client=None):
+        self.servers = tuple(servers)
+        self.client = client
+
+    def _get_client(self):
+        if self.client is None:
+            client = _memcache_clients.get(self.servers)
+            if client is None:
+                client = memcache.Client(list(self.servers), debug=0)
+                _memcache_clients[self.servers] = client
+            self.client = client
+        return self.client
+
+    def get_many(self, keys):
+        return self._get_client().get_multi(keys)
+
+    def set_many(self, values):
+        # set_multi returns the keys that could not be stored
+        return not self._get_client().set_multi(values)
+
+class LocalMemcacheClient(object):
+    """
+    A stand-in for memcache.Client that keeps values in this process and,
+    like memcached, refuses values over max_value_length.  It lets 
+    MemcacheBackend be tried without a server.
+    """
+    def __init__(self, max_value_length=1024 * 1024):
+        self.values = {}
+        self.max_value_length = max_value_length
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value):
+        if len(value) > self.max_value_length:
+            return False
+        self.values[key] = value
+        return True
+
+    def get_multi(self, keys):
+        return dict((x, self.values[x]) for x in keys if x in self.values)
+
+    def set_multi(self, mapping):
+        return [x for x, value in mapping.iteritems() 
+                if not self.set(x, value)]
+
+def default_cache():
+    """The cache for indexes: memcached if we have it, else none."""
+    if memcache:
+        return MemcacheBackend()
+    return None
+
 class Index(object):
-    """ """
-    def __init__(self, filename=None, fields=None):
+    """
+    Documents and the fields they are indexed by.  Searches are ranked by 
+    scorer, BM25Scorer by default; pass ProximityScorer() for the original 
+    weight and word proximity scoring.
+
+    An index file is a series of segments.  Saving an index opened from a
+    file appends the documents added since as a new segment, along with 
+    the deleted bitmap, so the cost of a save follows the changes rather 
+    than the size of the index.  optimize() merges everything back into a
+    single segment.
+
+    Search results are kept in query_cache, holding up to cache_size 
+    queries, and the documents matching field and range filters in 
+    filter_cache.  generation goes up with every change to the index, 
+    which retires the cached results.
+
+    Index files are saved to cache, a CacheBackend, when there is one; it
+    defaults to default_cache().  Pass cache=False for none.  An index is
+    opened by mapping its file, which costs the same however big it is, 
+    and only read whole from the cache when there is no file here.
+
+    >>> cache = DictBackend()
+    >>> index = Index(fields=(Field('title'),), cache=cache)
+    >>> index.add(Document(title='Troll'))
+    >>> index.save('index')
+    >>> saved = cache.values['index']
+    >>> cache.values['index'] = 'not an index'
+    >>> Index('index', cache=cache).search('troll').total
+    1
+    >>> cache.values['index'] = saved
+    >>> os.rename('index', 'index.moved')
+    >>> Index('index', cache=cache).search('troll').total
+    1
+    >>> os.rename('index.moved', 'index')
+    """
+    def __init__(self, filename=None, fields=None, scorer=None, 
+            cache_size=100, cache=None):
+        if cache is None:
+            cache = default_cache()
+        self.cache = cache
         if filename:
             self.open(filename)
         elif fields:
-            self.documents = {}
+            self.filename = None
+            self.file_size = None
+            self.segments = []
+            self.new_documents = {}
+            self.deleted = Bitmap()
+            self.documents = IndexDocuments(self)
             self.doc_counter = 0
             self.fields = IndexFieldDict()
             self.weighted_fields = []
@@ -379,69 +3125,796 @@ class Index(object):
                     self.weighted_fields.append((field.weight, field.name))
                     self.weighted_fields.sort()
                     self.weighted_fields.reverse()
-
-# TODO: add update and delete methods -- should there be a 
-# Document.index method?
+        self.scorer = scorer or BM25Scorer()
+        self.query_cache = QueryCache(cache_size)
+        # Bitmaps of the documents matching field and range clauses
+        self.filter_cache = QueryCache(cache_size)
+        # analyzed BooleanQuerys by query string
+        self.parsed_queries = QueryCache(cache_size)
+        self.generation = 0
+        self.profiler = None
 
     def add(self, document):
+        """
+        Add a document, giving it the next ID.  Several fields may copy_to
+        the same field.
+
+        >>> index = Index(fields=(Field('a', copy_to='all'), 
+        ...         Field('b', copy_to='all'), Field('all')), cache=False)
+        >>> index.add(Document(a='x y', b='y z'))
+        >>> len(index.fields['all']['y']), int(index.fields['all'].lengths[0])
+        (1, 4)
+        """
+        field_values = self._field_values(document)
+        self.generation += 1
+        if self.profiler is not None:
+            self.profiler.count('added')
         document.id = self.doc_counter
         self.doc_counter += 1
-        self.documents[document.id] = document
+        self.new_documents[document.id] = document
+        for field, values in field_values.iteritems():
+            self.fields[field].add(values, document.id)
+        for field in document:
+            if not self.fields[field].store:
+                document[field] = None  # can't delete during loop
+
+    def _field_values(self, document):
+        """
+        Returns the values to index in each field for document, raising
+        IndexException for a field that isn't defined before anything is
+        changed.
+        """
+        # gather the values for each field first, so a field copied to
+        # from several others gets all of them in one go
+        field_values = {}
         for field in document:
             index_field = self.fields[field]
-            field_value = document[field]
+            values = document[field]
+            if not hasattr(values, '__iter__'):
+                values = [values]
             if index_field.index:
-                index_field.add(field_value, document.id)
+                field_values.setdefault(field, []).extend(values)
             if index_field.copy_to:
                 copy_field = self.fields[index_field.copy_to]
                 if copy_field.index:  # really, when would it not be?
-                    copy_field.add(field_value, document.id)
-            if not self.fields[field].store:
-                document[field] = None  # can't delete during loop
+                    field_values.setdefault(copy_field.name, []).extend(
+                            values)
+        return field_values
+
+    def delete(self, doc_id):
+        """
+        Delete a document.  It is marked in the deleted bitmap and skipped
+        by searches; its postings stay until optimize().
+
+        >>> index = Index(fields=(Field('title'),), cache=False)
+        >>> index.add(Document(title='Troll bridge'))
+        >>> index.add(Document(title='Troll mountain'))
+        >>> index.save('index')
+        >>> index.delete(0)
+        >>> index.save('index')
+        >>> index = Index('index', cache=False)
+        >>> [x.id for x in index.search('troll').documents]
+        [1]
+        >>> len(index.documents)
+        1
+        >>> index.delete(0)
+        Traceback (most recent call last):
+        ...
+        IndexException: Document 0 not in index.
+        """
+        if doc_id not in self.documents:
+            raise IndexException, "Document %s not in index." % doc_id
+        self.generation += 1
+        if self.profiler is not None:
+            self.profiler.count('deleted')
+        for field in self.fields.itervalues():
+            field.remove(doc_id)
+        self.deleted.add(doc_id)
+
+    def update(self, doc_id, document):
+        """
+        Replace a document.  The new document gets a new ID.  Its fields 
+        are checked first, so if it can't be added the old one stays.
 
-    def dump(self):
-        return pickle.dumps(self.__dict__, -1)
+        >>> index = Index(fields=(Field('title'),), cache=False)
+        >>> index.add(Document(title='Troll bridge'))
+        >>> index.update(0, Document(title='Troll mountain'))
+        >>> [(x.id, x['title']) for x in index.search('troll').documents]
+        [(1, 'Troll mountain')]
+        >>> index.search('bridge').total
+        0
+        >>> index.update(1, Document(title='Troll soup', nope=1))
+        Traceback (most recent call last):
+        ...
+        IndexException: Field 'nope' not defined.
+        >>> [x.id for x in index.search('troll').documents]
+        [1]
+        """
+        self._field_values(document)
+        self.delete(doc_id)
+        self.add(document)
+
+    def add_many(self, documents, workers=None, chunk_size=200):
+        """
+        Add documents, tokenizing them in a pool of worker processes.  The
+        documents get the same IDs as with add(), and each chunk's postings
+        are appended to the fields in order, so the index ends up as if 
+        they had been added one at a time.  workers defaults to the number
+        of CPUs; with one worker, documents are added here.  Each document's
+        fields are checked here before it gets an ID, so as with add(), one
+        with a field that isn't defined raises IndexException with the 
+        documents before it added and nothing of it left behind.
+
+        >>> titles = ['Troll bridge', 'Troll mountain', 'Mountain baby', 
+        ...         'Troll soup', 'Baby troll troll']
+        >>> def ranking(workers):
+        ...     index = Index(fields=(Field('title'),), cache=False)
+        ...     index.add_many((Document(title=x) for x in titles), 
+        ...             workers=workers, chunk_size=2)
+        ...     results = index.search('troll')
+        ...     return [(x.id, x.score) for x in results.documents]
+        >>> ranking(2) == ranking(1)
+        True
+        >>> len(ranking(2))
+        4
+        >>> index = Index(fields=(Field('title'),), cache=False)
+        >>> index.add_many([Document(title='troll'), 
+        ...         Document(title='bridge', nope='x')], workers=2, 
+        ...         chunk_size=1)
+        Traceback (most recent call last):
+        ...
+        IndexException: Field 'nope' not defined.
+        >>> len(index.documents), index.search('troll').total
+        (1, 1)
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if workers < 2:
+            for document in documents:
+                self.add(document)
+            return
+        fields = [x.copy() for x in self.fields.itervalues()]
+        pool = multiprocessing.Pool(workers)
+        try:
+            pending = []
+            chunk = []
+            error = None
+            for document in documents:
+                try:
+                    self._field_values(document)
+                except IndexException:
+                    error = sys.exc_info()
+                    break
+                chunk.append(document)
+                if len(chunk) == chunk_size:
+                    pending.append(self._send_chunk(pool, fields, chunk))
+                    chunk = []
+                    # keep a few chunks in flight per worker, not them all
+                    if len(pending) >= 2 * workers:
+                        self._merge_chunk(*pending.pop(0).get())
+            if chunk:
+                pending.append(self._send_chunk(pool, fields, chunk))
+            for result in pending:
+                self._merge_chunk(*result.get())
+        finally:
+            pool.terminate()
+            pool.join()
+        if error:
+            raise error[0], error[1], error[2]
+
+    def _send_chunk(self, pool, fields, documents):
+        self.generation += 1
+        if self.profiler is not None:
+            self.profiler.count('added', len(documents))
+        first_doc_id = self.doc_counter
+        values = []
+        for document in documents:
+            document.id = self.doc_counter
+            self.doc_counter += 1
+            self.new_documents[document.id] = document
+            values.append(dict(document.fields))
+            for field in document:
+                if not self.fields[field].store:
+                    document[field] = None
+        return pool.apply_async(_index_chunk, 
+                (fields, first_doc_id, values))
+
+    def _merge_chunk(self, first_doc_id, partials):
+        for field_name, partial in partials.iteritems():
+            self.fields[field_name].merge(partial[0], first_doc_id, 
+                    *partial[1:])
+
+    def freeze(self):
+        """Pack the postings of every field for searching and saving."""
+        for field in self.fields.itervalues():
+            field.freeze()
+
+    def _write_trailer(self, handle, segments, deleted):
+        """
+        Write each field's lengths and the trailer, which is the last thing
+        in the file and says where everything else is.
+        """
+        lengths = {}
+        fields = []
+        for field in self.fields.itervalues():
+            field.thaw()
+            lengths[field.name] = (handle.tell(), len(field.lengths))
+            handle.write(_array_to_bytes(field.lengths))
+            fields.append(field.config())
+        trailer = {
+            'doc_counter': self.doc_counter,
+            'weighted_fields': self.weighted_fields,
+            'fields': fields,
+            'lengths': lengths,
+            'segments': segments,
+            'deleted': deleted.tostring(),
+        }
+        trailer_offset = handle.tell()
+        handle.write(pickle.dumps(trailer, -1))
+        handle.write(TRAILER_POINTER.pack(trailer_offset))
+        handle.write(INDEX_MAGIC)
+
+    def dump(self, handle=None):
+        """
+        Serialize the whole index as a single segment, leaving out deleted 
+        documents: a magic string, the segment of stored documents and 
+        term dictionaries, and a trailer pointing into the segment.  It is
+        written to handle as it is made, one document and token at a time,
+        or returned as a str if there is no handle.
+        """
+        self.freeze()
+        if handle is None:
+            dumped_index = StringIO()
+            self.dump(dumped_index)
+            return dumped_index.getvalue()
+        handle.write(INDEX_MAGIC)
+        field_terms = {}
+        for field in self.fields.itervalues():
+            field_terms[field.name] = field.iter_postings(self.deleted)
+        segment = _write_segment(handle, self.documents, field_terms)
+        self._write_trailer(handle, [segment], Bitmap())
 
     def load(self, dumped_index):
-        if self.__dict__:
-            raise IndexException, "Attempted load on established index."
-        self.__dict__ = pickle.loads(dumped_index)
+        """
+        Open a dumped index held in a str or mmap.  Only the trailer is 
+        read here; terms and documents are decoded as searches need them.
+        The magic string ends in the format version, and files in other 
+        versions, or in the pickle format before segments, must be rebuilt.
 
-    def get_mc(self):
-        if memcache:
-            mc = memcache.Client([MEMCACHE_LOCATION], debug=0)
-        else:
-            mc = {}
-        return mc
+        >>> Index(cache=False).load(pickle.dumps({}, 2))
+        Traceback (most recent call last):
+        ...
+        IndexException: Index is in the old pickle format; rebuild it.
+        >>> Index(cache=False).load(INDEX_MAGIC[:6] + '\\x06\\n')
+        ... # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        IndexException: Index format version 6 is not supported ...
+        >>> Index(cache=False).load(INDEX_MAGIC)
+        Traceback (most recent call last):
+        ...
+        IndexException: Index is incomplete.
+        >>> open('index', 'w').close()
+        >>> Index('index', cache=False)
+        Traceback (most recent call last):
+        ...
+        IndexException: Index file index is empty.
+        """
+        if 'documents' in self.__dict__:
+            raise IndexException, "Attempted load on established index."
+        magic_size = len(INDEX_MAGIC)
+        version_offset = INDEX_MAGIC.index('\x00') + 1
+        if dumped_index[:2] == '\x80\x02':
+            raise IndexException, \
+                    "Index is in the old pickle format; rebuild it."
+        if (len(dumped_index) < magic_size or 
+                dumped_index[:version_offset] != INDEX_MAGIC[:version_offset]):
+            raise IndexException, "Not a trwbl index."
+        if dumped_index[:magic_size] != INDEX_MAGIC:
+            raise IndexException, ("Index format version %d is not "
+                    "supported (this is version %d); rebuild it." % 
+                    (ord(dumped_index[version_offset]), 
+                    ord(INDEX_MAGIC[version_offset])))
+        end = len(dumped_index) - magic_size - TRAILER_POINTER.size
+        if end < magic_size or dumped_index[-magic_size:] != INDEX_MAGIC:
+            raise IndexException, "Index is incomplete."
+        trailer_offset = TRAILER_POINTER.unpack_from(dumped_index, end)[0]
+        trailer = pickle.loads(dumped_index[trailer_offset:end])
+        self.file_size = len(dumped_index)
+        self.doc_counter = trailer['doc_counter']
+        self.weighted_fields = trailer['weighted_fields']
+        self.segments = [Segment(dumped_index, x) 
+                for x in trailer['segments']]
+        self.new_documents = {}
+        self.deleted = Bitmap(trailer['deleted'])
+        self.documents = IndexDocuments(self)
+        self.fields = IndexFieldDict()
+        for config in trailer['fields']:
+            field = Field.__new__(Field)
+            field.__dict__.update(config)
+            field.tokens = {}
+            field.sorted_tokens = []
+            field.ngrams = None
+            field.term_counts = None
+            field.segment_terms = [x.terms[field.name] for x in self.segments]
+            field.segment_ngrams = [x.ngrams[field.name] 
+                    for x in self.segments]
+            field.lengths = SegmentArray(dumped_index, 
+                    *trailer['lengths'][field.name])
+            self.fields[field.name] = field
 
     def open(self, filename):
-        mc = self.get_mc()
-        dumped_index = mc.get(filename)
+        dumped_index = None
+        if self.cache and not os.path.exists(filename):
+            dumped_index = self.cache.get(filename)
         if dumped_index:
             self.load(dumped_index)
         else:
+            self._map(filename)
+        self.filename = filename
+
+    def _map(self, filename):
+        index_handle = open(filename, 'rb')
+        try:
+            if not os.fstat(index_handle.fileno()).st_size:
+                # which mmap can't map
+                raise IndexException, "Index file %s is empty." % filename
+            # the map stays valid after the file is closed
+            self.load(mmap.mmap(index_handle.fileno(), 0, 
+                    access=mmap.ACCESS_READ))
+        finally:
+            index_handle.close()
+
+    def _reopen(self, filename):
+        """Reload from a file just written, bypassing the cache."""
+        cache = self.cache
+        scorer = self.scorer
+        query_cache = self.query_cache
+        filter_cache = self.filter_cache
+        parsed_queries = self.parsed_queries
+        generation = self.generation
+        profiler = self.profiler
+        self.__dict__.clear()
+        self._map(filename)
+        self.filename = filename
+        self.cache = cache
+        self.scorer = scorer
+        self.query_cache = query_cache
+        self.filter_cache = filter_cache
+        self.parsed_queries = parsed_queries
+        self.generation = generation + 1
+        self.profiler = profiler
+
+    def _append(self, filename):
+        """
+        Append the documents added since the index was opened as a new 
+        segment, followed by a new trailer.  Readers that mapped the file
+        before keep seeing the old trailer.
+        """
+        self.freeze()
+        segments = [x.meta for x in self.segments]
+        index_handle = open(filename, 'r+b')
+        try:
+            index_handle.seek(0, 2)
+            if self.new_documents:
+                field_terms = {}
+                for field in self.fields.itervalues():
+                    field_terms[field.name] = sorted(
+                            field.tokens.iteritems())
+                segments.append(_write_segment(index_handle, 
+                        self.new_documents, field_terms))
+            self._write_trailer(index_handle, segments, self.deleted)
+        finally:
+            index_handle.close()
+        self._reopen(filename)
+
+    def _replace(self, filename):
+        # dump beside the old file and rename over it, so readers that 
+        # have the old file mapped keep a consistent view
+        temp_filename = '%s.%s.tmp' % (filename, os.getpid())
+        index_handle = open(temp_filename, 'wb')
+        try:
+            self.dump(index_handle)
+        finally:
+            index_handle.close()
+        os.rename(temp_filename, filename)
+        self._reopen(filename)
+
+    def save(self, filename):
+        if self.profiler is not None:
+            self.profiler.count('saves')
+        if (filename == self.filename and os.path.exists(filename) and 
+                os.path.getsize(filename) == self.file_size):
+            self._append(filename)
+        else:
+            self._replace(filename)
+        if self.cache:
             index_handle = open(filename, 'rb')
             try:
-                self.load(index_handle.read())
+                self.cache.set_file(filename, index_handle)
             finally:
                 index_handle.close()
-    
+
+    def optimize(self, filename=None):
+        """
+        Merge all segments into one and drop deleted documents for good, 
+        rewriting filename or the file the index was opened from.
+
+        >>> index = Index(fields=(Field('title'),), cache=False)
+        >>> index.add(Document(title='Troll bridge'))
+        >>> index.save('index')
+        >>> index.add(Document(title='Troll mountain'))
+        >>> index.save('index')
+        >>> index.delete(0)
+        >>> 'bridge' in index.fields['title'], len(index.segments)
+        (True, 2)
+        >>> index.optimize()
+        >>> 'bridge' in index.fields['title'], len(index.segments)
+        (False, 1)
+        >>> len(index.fields['title']['troll'])
+        1
+        """
+        filename = filename or self.filename
+        if not filename:
+            raise IndexException, "No file to optimize the index into."
+        self._replace(filename)
+
+    def suggest(self, query, max_edits=MAX_EDITS):
+        """
+        Did you mean: returns query with each plain word that is in no 
+        weighted field replaced by the closest token that is, preferring
+        the one in the most documents, or None if nothing was replaced.
+        """
+        replacements = []
+        for match in QUERY_RE.finditer(query):
+            word = match.group(7)
+            if not word or word == 'OR' or is_pattern(word) or \
+                    parse_fuzzy(word):
+                continue
+            best = None
+            for weight, field_name in self.weighted_fields:
+                index_field = self.fields[field_name]
+                tokens = index_field.tokenizer.tokenize(word)
+                if not tokens or tokens[0] in index_field:
+                    best = None
+                    break
+                for distance, token in index_field.fuzzy_terms(tokens[0], 
+                        max_edits):
+                    candidate = (distance, -len(index_field[token]), token)
+                    if best is None or candidate < best:
+                        best = candidate
+            if best is not None:
+                replacements.append((match.span(7), best[2]))
+        if not replacements:
+            return None
+        for (start, end), token in reversed(replacements):
+            if isinstance(query, unicode):
+                token = token.decode('utf-8')
+            query = query[:start] + token + query[end:]
+        return query
+
+    def parse(self, query):
+        """
+        Returns query as a BooleanQuery analyzed for this index's fields,
+        from parsed_queries if it was parsed before.
+        """
+        # analyzing doesn't depend on what is indexed, so parsed queries 
+        # all belong to generation 0 and stay until pushed out
+        parsed = self.parsed_queries.get(query, 0)
+        if parsed is None:
+            parsed = parse_query(query).analyze(self)
+            self.parsed_queries.set(query, 0, parsed)
+        return parsed
+
+    def statistics(self, query):
+        """The Statistics this index would score query with."""
+        parsed = self.parse(query)
+        key = ('statistics', parsed.key)
+        statistics = self.query_cache.get(key, self.generation)
+        if statistics is None:
+            results = ResultSet(self, None)
+            results.evaluate(parsed)
+            field_lengths = dict((x.name, (x.total_length, x.document_count))
+                    for x in self.fields.itervalues())
+            statistics = Statistics(len(self.documents), field_lengths, 
+                    results.match_counts)
+            self.query_cache.set(key, self.generation, statistics)
+        return statistics
+
+    def search(self, query, limit=None, offset=0, statistics=None, 
+            fields=None):
+        """
+        Search the index.  With a limit, only that many of the best 
+        matches after offset are ranked and loaded, and with fields, only
+        those stored fields of them.  Rankings are served from query_cache
+        while the index is unchanged.  Scores use statistics, if given, in
+        place of the index's own.
+        """
+        return ResultSet(self, query, limit, offset, statistics, fields)
+
+class ShardedIndex(object):
+    """
+    An index split into shards, each an Index in a worker process of its
+    own, so that indexing and searching use as many cores as there are 
+    shards.  Document IDs are handed out in order as with an Index and 
+    routed by hash, which for an ID is the ID itself, so document n lives 
+    in shard n % shards as its document n // shards.
+
+    A search first adds up the shards' Statistics for the query, then has
+    every shard score with them and return its best offset + limit, and 
+    merges those by score.  Scores are the same as one Index holding every
+    document would give, except that wildcard and fuzzy words expand to 
+    the first tokens found in each shard.  Only the documents on the page
+    are fetched.
+
+    Shards are saved to and opened from filename.0, filename.1, and so on.
+    Documents given to add() are sent to the shards in batches of 
+    chunk_size, or before anything else is asked of them.
+
+    >>> def fields():
+    ...     return (Field('title', weight=0.6), Field('body', weight=0.3))
+    >>> sharded = ShardedIndex(fields=fields(), shards=3)
+    >>> single = Index(fields=fields(), cache=False)
+    >>> for title, body in [('The Troll Bridge', 'a troll under a bridge'),
+    ...         ('Troll Mountain', 'trolls on the mountain'),
+    ...         ('Mountain Baby', 'a baby on the mountain'),
+    ...         ('Bridge Soup', 'soup on the bridge for a troll'),
+    ...         ('Troll Soup', 'troll soup, troll bridge')]:
+    ...     sharded.add(Document(title=title, body=body))
+    ...     single.add(Document(title=title, body=body))
+    >>> def page(results):
+    ...     return results.total, [(x.id, round(x.score, 9), x['title']) 
+    ...             for x in results.documents]
+    >>> [page(sharded.search(x, 3)) == page(single.search(x, 3)) 
+    ...         for x in ('troll', 'troll -bridge', '"troll bridge"', 
+    ...         'mountain OR soup', 'title:troll~1 body:bridge')]
+    [True, True, True, True, True]
+    >>> sharded.delete(4)
+    >>> sharded.delete(4)
+    Traceback (most recent call last):
+    ...
+    IndexException: Document 4 not in index.
+    >>> [x.id for x in sharded.get_documents([3, 4, 0])]
+    [3, 0]
+    >>> sharded.close()
+    """
+    def __init__(self, filename=None, fields=None, shards=None, scorer=None,
+            cache_size=100, chunk_size=200):
+        if filename:
+            shards = 0
+            while os.path.exists('%s.%d' % (filename, shards)):
+                shards += 1
+            if not shards:
+                raise IndexException, "No shards of %s found." % filename
+        elif shards is None:
+            shards = multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        self.generation = 0
+        # summed statistics by query
+        self.query_cache = QueryCache(cache_size)
+        self.pending = [[] for x in xrange(shards)]
+        self.connections = []
+        self.processes = []
+        for shard in xrange(shards):
+            if filename:
+                shard_filename = '%s.%d' % (filename, shard)
+            else:
+                shard_filename = None
+            connection, shard_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_serve_shard, 
+                    args=(shard_connection, shard, shards, shard_filename, 
+                    fields, scorer, cache_size))
+            process.daemon = True
+            process.start()
+            shard_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+        self.doc_counter = sum(self._call_all('doc_counter'))
+
+    def _call_all(self, method, *args):
+        """Ask every shard at once, then gather their answers in order."""
+        return self._call(range(len(self.connections)), method, 
+                [args] * len(self.connections))
+
+    def _call(self, shards, method, shard_args):
+        for shard, args in zip(shards, shard_args):
+            self.connections[shard].send((method, args))
+        answers = [self.connections[x].recv() for x in shards]
+        for failed, answer in answers:
+            if failed:
+                raise answer
+        return [x[1] for x in answers]
+
+    def _flush(self):
+        shards = [x for x in xrange(len(self.pending)) if self.pending[x]]
+        if shards:
+            self._call(shards, 'add_many', 
+                    [(self.pending[x],) for x in shards])
+            for shard in shards:
+                self.pending[shard] = []
+
+    def add(self, document):
+        self.generation += 1
+        document.id = self.doc_counter
+        self.doc_counter += 1
+        pending = self.pending[hash(document.id) % len(self.pending)]
+        pending.append(document)
+        if len(pending) >= self.chunk_size:
+            self._flush()
+
+    def add_many(self, documents):
+        for document in documents:
+            self.add(document)
+        self._flush()
+
+    def _shard(self, doc_id):
+        shards = len(self.connections)
+        return hash(doc_id) % shards, doc_id // shards
+
+    def delete(self, doc_id):
+        self._flush()
+        self.generation += 1
+        self._call([self._shard(doc_id)[0]], 'delete', [(doc_id,)])
+
+    def update(self, doc_id, document):
+        """Replace a document.  The new document gets a new ID."""
+        self.delete(doc_id)
+        self.add(document)
+
+    def statistics(self, query):
+        """The Statistics of every shard for query, added up."""
+        self._flush()
+        statistics = self.query_cache.get(query, self.generation)
+        if statistics is None:
+            statistics = reduce(lambda x, y: x + y, 
+                    self._call_all('statistics', query))
+            self.query_cache.set(query, self.generation, statistics)
+        return statistics
+
+    def search(self, query, limit=None, offset=0, fields=None):
+        """Search every shard and return a ShardedResultSet."""
+        statistics = self.statistics(query)
+        depth = None if limit is None else offset + limit
+        totals_rankings = self._call_all('rank', query, depth, statistics)
+        rankings = [x[1] for x in totals_rankings]
+        if depth is None:
+            ranking = sorted(itertools.chain(*rankings), reverse=True)
+        else:
+            ranking = heapq.nlargest(depth, itertools.chain(*rankings))
+        return ShardedResultSet(self, sum(x[0] for x in totals_rankings), 
+                ranking[offset:], fields)
+
+    def get_documents(self, doc_ids, fields=None):
+        """
+        Returns the documents with doc_ids, in the same order, holding 
+        only the stored fields named in fields if given.  Deleted documents
+        are left out.
+        """
+        self._flush()
+        by_shard = {}
+        for doc_id in doc_ids:
+            shard, shard_doc_id = self._shard(doc_id)
+            by_shard.setdefault(shard, []).append(shard_doc_id)
+        shards = sorted(by_shard)
+        documents = {}
+        for shard, shard_documents in zip(shards, self._call(shards, 
+                'documents', [(by_shard[x], fields) for x in shards])):
+            for document in shard_documents:
+                documents[document.id] = document
+        return [documents[x] for x in doc_ids if x in documents]
+
     def save(self, filename):
-        dumped_index = self.dump()
-        index_handle = open(filename, 'wb')
+        self._flush()
+        self._call(range(len(self.connections)), 'save', 
+                [('%s.%d' % (filename, x),) for x in 
+                xrange(len(self.connections))])
+
+    def optimize(self):
+        self._flush()
+        self._call_all('optimize')
+
+    def close(self):
+        """Stop the shard processes, without saving."""
+        for connection in self.connections:
+            connection.send(('close', ()))
+            connection.close()
+        for process in self.processes:
+            process.join()
+        self.connections = []
+        self.processes = []
+
+class ShardedResultSet(object):
+    """
+    The result of a ShardedIndex search: total matches and the documents
+    of the page asked for, best first, each with its score.
+    """
+    def __init__(self, index, total, ranking, fields=None):
+        self.total = total
+        self.documents = index.get_documents([x[1] for x in ranking], fields)
+        scores = dict((doc_id, score) for score, doc_id in ranking)
+        for document in self.documents:
+            document.score = scores[document.id]
+
+def _serve_shard(connection, shard, shards, filename, fields, scorer, 
+        cache_size):
+    """
+    Run one shard of a ShardedIndex: answer (method, args) requests from
+    connection with (failed, answer) until told to close.  Documents and
+    rankings cross the connection with ShardedIndex IDs.
+    """
+    if filename:
+        index = Index(filename, scorer=scorer, cache_size=cache_size, 
+                cache=False)
+    else:
+        index = Index(fields=fields, scorer=scorer, cache_size=cache_size, 
+                cache=False)
+    def add_many(documents):
+        for document in documents:
+            global_id = document.id
+            index.add(document)
+            if document.id * shards + shard != global_id:
+                raise IndexException, "Document %s misrouted." % global_id
+    def rank(query, depth, statistics):
+        total, ranking = ResultSet(index, None, depth, 0, 
+                statistics).ranking(query)
+        return total, [(score, doc_id * shards + shard) 
+                for score, doc_id in ranking]
+    def documents(doc_ids, fields):
+        found = []
+        for doc_id in doc_ids:
+            document = index.documents.get(doc_id, fields=fields)
+            if document is not None:
+                document.id = doc_id * shards + shard
+                found.append(document)
+        return found
+    def delete(global_id):
+        # errors name the ID the caller gave
         try:
-            index_handle.write(dumped_index)
-        finally:
-            index_handle.close()
-        mc = self.get_mc()
-        if mc:
-            mc.set(filename, dumped_index)
+            index.delete(global_id // shards)
+        except IndexException:
+            raise IndexException, "Document %s not in index." % global_id
+    def save(filename):
+        index.save(filename)
+    def optimize():
+        index.optimize()
+    methods = {
+        'doc_counter': lambda: index.doc_counter,
+        'add_many': add_many,
+        'delete': delete,
+        'statistics': index.statistics,
+        'rank': rank,
+        'documents': documents,
+        'save': save,
+        'optimize': optimize,
+    }
+    while True:
+        try:
+            method, args = connection.recv()
+        except EOFError:
+            break
+        if method == 'close':
+            break
+        try:
+            connection.send((False, methods[method](*args)))
+        except Exception, e:
+            connection.send((True, e))
+    connection.close()
 
-    def search(self, query):
-        # TODO: handle quoted search and power searches
-        # TODO: score documents based on weighting, word proximity, and 
-        #       frequency
-        return ResultSet(self, query)
+def _index_chunk(fields, first_doc_id, values):
+    """
+    Index documents in a worker process for Index.add_many.  Returns the 
+    postings and statistics of each field for merging.
+    """
+    index = Index(fields=fields, cache=False)
+    index.doc_counter = first_doc_id
+    for document_fields in values:
+        index.add(Document(**document_fields))
+    partials = {}
+    for field in index.fields.itervalues():
+        field.freeze()
+        partials[field.name] = (field.tokens, field.lengths[first_doc_id:], 
+                field.total_length, field.document_count)
+    return first_doc_id, partials
 
 class Document(object):
     """
@@ -493,14 +3966,6 @@ def _test():
 if __name__ == "__main__":
     _test()
 
-# XXX: Deleting/replacing documents is an expensive process, as far as I can
-# see it, because we would need to iterate over all of the tokens in
-# self.fields in order to remove those with that document ID. 
-# Only way to avoid that is to just leave the tokens and remove only the
-# document from self.documents, then put a try/except in search() to skip
-# hits on missing documents.  This might necessitate an optimize() method on 
-# the index.
-
 # for tokens across the index:
 #
 #     field -- token -- doc_id -- field_id -- token_id
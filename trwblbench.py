@@ -0,0 +1,195 @@
+"""
+Benchmarks for trwbl, over a synthetic corpus shaped like the artsearch
+index: titles, keywords, descriptions and contents drawn from a Zipf-like
+vocabulary, the same for a given seed.  Run as
+
+    python trwblbench.py [--documents 2000] [--queries 200] [--seed 0]
+
+to print one JSON object: indexing rate, save and open times, index size,
+peak RSS, and search latency percentiles for each kind of query.
+"""
+
+import json
+import optparse
+import os
+import random
+import resource
+import sys
+import tempfile
+from timeit import default_timer as timer
+
+from trwbl import Document, Field, Index
+
+def make_fields():
+    """The fields of the artsearch index."""
+    return (
+        Field('title', weight=0.8),
+        Field('date', index=False),
+        Field('keyword', weight=0.7, copy_to='keyword_s'),
+        Field('keyword_s', weight=0, tokenizer=None),
+        Field('description', weight=0.6),
+        Field('content', store=False),
+    )
+
+class Corpus(object):
+    """
+    Random articles.  Word n of the vocabulary is picked with weight
+    1 / (n + 1), as word frequencies in text roughly are.
+    """
+    def __init__(self, seed=0, vocabulary_size=5000):
+        self.random = random.Random(seed)
+        self.words = ['%s%d' % (self.random.choice('bcdfghklmnprstvw') +
+                self.random.choice('aeiou'), x)
+                for x in xrange(vocabulary_size)]
+        total = 0.0
+        self.cumulative = []
+        for rank in xrange(vocabulary_size):
+            total += 1.0 / (rank + 1)
+            self.cumulative.append(total)
+        self.total = total
+
+    def word(self):
+        target = self.random.random() * self.total
+        low, high = 0, len(self.cumulative) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if self.cumulative[middle] < target:
+                low = middle + 1
+            else:
+                high = middle
+        return self.words[low]
+
+    def text(self, low, high):
+        return ' '.join(self.word()
+                for x in xrange(self.random.randint(low, high)))
+
+    def article(self):
+        return {
+            'title': self.text(2, 6).title(),
+            'date': '20%02d-%02d-%02d' % (self.random.randint(0, 12),
+                    self.random.randint(1, 12), self.random.randint(1, 28)),
+            'keyword': [self.word() for x in xrange(self.random.randint(1, 4))],
+            'description': self.text(10, 30),
+            'content': '\n\n'.join(self.text(40, 120)
+                    for x in xrange(self.random.randint(2, 8))),
+        }
+
+    def articles(self, count):
+        return [self.article() for x in xrange(count)]
+
+def make_queries(corpus, articles, count):
+    """
+    Returns a dictionary of query kinds to count queries each, built from
+    words that occur in articles so that most of them match.
+    """
+    rand = random.Random(corpus.random.random())
+    def some_words(article, n):
+        words = article['content'].split()
+        start = rand.randint(0, len(words) - n)
+        return words[start:start + n]
+    queries = dict((x, []) for x in ('word', 'words', 'negated', 'phrase',
+            'fielded', 'wildcard', 'fuzzy'))
+    for i in xrange(count):
+        article = rand.choice(articles)
+        first, second = some_words(article, 2)
+        queries['word'].append(first)
+        queries['words'].append('%s %s' % (first, corpus.word()))
+        queries['negated'].append('%s -%s' % (first, corpus.word()))
+        queries['phrase'].append('"%s %s"' % (first, second))
+        queries['fielded'].append('keyword_s:%s %s' % (
+                rand.choice(article['keyword']), corpus.word()))
+        queries['wildcard'].append('%s*' % first[:3])
+        queries['fuzzy'].append('%s~1' % (first[:-1] + 'x'))
+    return queries
+
+def percentile(values, fraction):
+    """The nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def peak_rss():
+    """Peak resident set size of this process in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+def run(documents=2000, queries=200, seed=0, limit=10, cache_size=0):
+    """
+    Run every benchmark and return the results as a dictionary.  Search
+    latencies are in milliseconds, and the query cache holds cache_size
+    queries, none by default, so repeats are measured too.
+    """
+    corpus = Corpus(seed)
+    articles = corpus.articles(documents)
+    results = {
+        'documents': documents,
+        'queries': queries,
+        'seed': seed,
+        'limit': limit,
+        'cache_size': cache_size,
+    }
+    index = Index(fields=make_fields(), cache=False)
+    start = timer()
+    for article in articles:
+        index.add(Document(**article))
+    elapsed = timer() - start
+    results['index_seconds'] = elapsed
+    results['index_docs_per_second'] = documents / elapsed
+
+    handle, filename = tempfile.mkstemp(suffix='.trwbl')
+    os.close(handle)
+    try:
+        start = timer()
+        index.save(filename)
+        results['save_seconds'] = timer() - start
+        results['index_bytes'] = os.path.getsize(filename)
+        start = timer()
+        index = Index(filename, cache_size=cache_size, cache=False)
+        results['open_seconds'] = timer() - start
+
+        latencies = {}
+        for kind, kind_queries in sorted(make_queries(corpus, articles,
+                queries).iteritems()):
+            times = []
+            matches = 0
+            for query in kind_queries:
+                start = timer()
+                result = index.search(query, limit)
+                times.append((timer() - start) * 1000)
+                matches += bool(result.total)
+            times.sort()
+            latencies[kind] = {
+                'p50_ms': percentile(times, 0.5),
+                'p99_ms': percentile(times, 0.99),
+                'max_ms': times[-1],
+                'mean_ms': sum(times) / len(times),
+                'matched': matches / float(len(times)),
+            }
+        results['search'] = latencies
+    finally:
+        os.remove(filename)
+    results['peak_rss_bytes'] = peak_rss()
+    return results
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--documents', type='int', default=2000,
+            help='articles in the corpus [%default]')
+    parser.add_option('--queries', type='int', default=200,
+            help='queries of each kind [%default]')
+    parser.add_option('--seed', type='int', default=0,
+            help='seed for the corpus and queries [%default]')
+    parser.add_option('--limit', type='int', default=10,
+            help='results asked for per search [%default]')
+    parser.add_option('--cache-size', type='int', default=0,
+            help='queries held in the query cache [%default]')
+    options, args = parser.parse_args(argv)
+    results = run(options.documents, options.queries, options.seed,
+            options.limit, options.cache_size)
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()